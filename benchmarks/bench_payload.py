@@ -0,0 +1,44 @@
+"""
+Size and encoding time of LaCrosse state payloads
+
+Compares the former json.dumps of a dict and topic concatenation per frame
+with the preformatted JSON payload, the compact binary payload and the
+precomputed topics. Run from the repository root:
+
+    python -m benchmarks.bench_payload
+"""
+
+import json
+import timeit
+
+from mqtt_cul_server.protocols.lacrosse import LaCrosseReading, SensorTopics
+
+ROUNDS = 100000
+PREFIX = "homeassistant"
+
+
+def main():
+    reading = LaCrosseReading(7, 22.8, 46, 100)
+    topics = SensorTopics(PREFIX, reading.id)
+
+    def json_dict():
+        topic = PREFIX + "/sensor/lacrosse/" + str(reading.id) + "/state"
+        return topic, json.dumps({"temperature": reading.temperature, "humidity": reading.humidity,
+                                  "battery": reading.battery})
+
+    def json_preformatted():
+        return topics.state, reading.state_payload()
+
+    def compact():
+        return topics.compact, reading.compact_payload()
+
+    print(f"{'encoding':20s} {'topic':>6s} {'payload':>8s} {'us/msg':>7s}")
+    for name, func in (("json.dumps(dict)", json_dict), ("json preformatted", json_preformatted),
+                       ("compact struct", compact)):
+        topic, payload = func()
+        seconds = min(timeit.repeat(func, number=ROUNDS, repeat=3))
+        print(f"{name:20s} {len(topic):6d} {len(payload):8d} {seconds / ROUNDS * 1e6:7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Memory and allocation benchmark of device state records
+
+Compares the former dict based state of Somfy devices and LaCrosse frames
+with the slotted records. For LaCrosse, the decoded frames and payloads are
+kept alive, so the allocated blocks per frame can be counted. Run from the
+repository root:
+
+    python -m benchmarks.bench_state_records
+"""
+
+import contextlib
+import gc
+import io
+import json
+import time
+import tracemalloc
+
+from mqtt_cul_server import cul
+from mqtt_cul_server.protocols.lacrosse import LaCrosse
+from mqtt_cul_server.protocols.somfy_shutter import SomfyRecord
+
+DEVICES = 500
+FRAMES = 20000
+FRAME = "N0199E6282EC7AAAA0000719199"
+
+
+def measure(func):
+    """
+    Returns (retained memory in bytes, allocated blocks still alive, seconds).
+    The garbage collector is disabled while tracing. The time is measured in a
+    second run without tracing
+    """
+    gc.collect()
+    gc.disable()
+    tracemalloc.start()
+    result = func()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.enable()
+    del result
+    start = time.perf_counter()
+    func()
+    return current, blocks, time.perf_counter() - start
+
+
+def somfy_states():
+    state = {"name": "Shutter", "device_class": "shutter", "address": "B0C004", "enc_key": 1,
+             "rolling_code": 4125, "up_time": 12, "down_time": 10, "current_pos": 100}
+    return state, lambda: [dict(state, address=f"{i:06X}") for i in range(DEVICES)], \
+        lambda: [SomfyRecord.from_dict(dict(state, address=f"{i:06X}")) for i in range(DEVICES)]
+
+
+def lacrosse_frames(lacrosse):
+    def with_dict():
+        results = []
+        for _ in range(FRAMES):
+            decoded = lacrosse.decode_rx_data(FRAME)
+            del decoded["id"]
+            results.append((decoded, json.dumps(decoded)))
+        return results
+
+    def with_record():
+        results = []
+        for _ in range(FRAMES):
+            reading = lacrosse.decode_frame(FRAME)
+            results.append((reading, reading.state_payload()))
+        return results
+
+    return with_dict, with_record
+
+
+def main():
+    _, dicts, records = somfy_states()
+    print(f"Somfy state of {DEVICES} devices")
+    for name, func in (("dict", dicts), ("SomfyRecord", records)):
+        current, blocks, _ = measure(func)
+        print(f"  {name:12s} {current / 1024:8.1f} KiB in {blocks} blocks")
+
+    # the CUL in test mode prints the listening mode command
+    with contextlib.redirect_stdout(io.StringIO()):
+        lacrosse = LaCrosse(cul.Cul("", test=True), None, None)
+    with_dict, with_record = lacrosse_frames(lacrosse)
+    print(f"LaCrosse decode and encode of {FRAMES} frames")
+    for name, func in (("dict", with_dict), ("LaCrosseReading", with_record)):
+        current, blocks, elapsed = measure(func)
+        print(f"  {name:16s} {blocks / FRAMES:5.1f} blocks, {current / FRAMES:6.1f} bytes, "
+              f"{elapsed / FRAMES * 1e6:6.1f} us per frame")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Fixtures shared by the inline tests of the modules
+"""
+
+import configparser
+import json
+import os
+
+import pytest
+
+from mqtt_cul_server import cul
+from mqtt_cul_server.scheduler import Scheduler
+
+
+class MQTTStub:
+    """Records published messages instead of sending them"""
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, retain=False):
+        self.published.append((topic, payload))
+
+
+def config_section(section, **options):
+    config = configparser.ConfigParser()
+    config[section] = options
+    return config[section]
+
+
+@pytest.fixture
+def make_config():
+    """Factory for a config section with the given options"""
+    return config_section
+
+
+@pytest.fixture
+def mqtt_client():
+    """MQTT client recording published (topic, payload) pairs"""
+    return MQTTStub()
+
+
+@pytest.fixture
+def make_intertechno():
+    """Factory for an Intertechno instance with system ID 0F0FF, CUL in test mode and no MQTT client"""
+    from mqtt_cul_server.protocols.intertechno import Intertechno
+
+    def factory(**options):
+        config = config_section("intertechno", system_id="0F0FF", **options)
+        return Intertechno(cul.Cul("", test=True), None, "homeassistant", config, Scheduler())
+    return factory
+
+
+@pytest.fixture
+def make_somfy(tmp_path, mqtt_client):
+    """
+    Factory for a SomfyShutter instance with state directory tmp_path, one device
+    B0C004 at position 0, CUL in test mode and the MQTT stub
+    """
+    from mqtt_cul_server.protocols.somfy_shutter import SomfyShutter
+
+    def factory(**options):
+        os.mkdir(tmp_path / "somfy")
+        with open(tmp_path / "somfy" / "test.json", "w", encoding='utf8') as file_handle:
+            json.dump({"name": "Test", "device_class": "shutter", "address": "B0C004",
+                       "enc_key": 1, "rolling_code": 4125, "current_pos": 0,
+                       "up_time": 1, "down_time": 1}, file_handle)
+        return SomfyShutter(cul.Cul("", test=True), mqtt_client, "homeassistant", str(tmp_path),
+                            config_section("somfy", **options), Scheduler())
+    return factory
@@ -12,6 +12,13 @@ def signal_handler(sig, frame):
     """ called when SIGTERM received """
     logging.info("Received SIGTERM. Terminating")
     sys.exit(0)
+
+def read_config(filename):
+    config = configparser.ConfigParser()
+    fcount = config.read(filename)
+    if len(fcount) == 0:
+        return None
+    return config
         
 if __name__ == "__main__":
     """Control devices via MQTT and CUL RF USB stick"""
@@ -23,9 +30,8 @@ if __name__ == "__main__":
     parser.add_argument('--config', default='mqtt_cul_server.ini')
     args = parser.parse_args()
     
-    config = configparser.ConfigParser()
-    fcount = config.read(args.config)
-    if len(fcount) == 0:
+    config = read_config(args.config)
+    if config is None:
         print(f"ERROR: Cannot read config file {args.config}")
         sys.exit(1)
 
@@ -46,6 +52,34 @@ if __name__ == "__main__":
     signal.signal(signal.SIGTERM, signal_handler)
 
     mcs = MQTT_CUL_Server(config=config)
+
+    def reload_handler(sig, frame):
+        """ called when SIGHUP received """
+        logging.info("Received SIGHUP. Reloading configuration")
+        new_config = read_config(args.config)
+        if new_config is None:
+            logging.error("Cannot read config file %s. Keeping current configuration", args.config)
+            return
+        mcs.reload(new_config)
+
+    signal.signal(signal.SIGHUP, reload_handler)
+
+    def profile_handler(sig, frame):
+        """ called when SIGUSR1 received """
+        mcs.start_profile()
+
+    signal.signal(signal.SIGUSR1, profile_handler)
+
     mcs.start()
-    
-    sys.exit(0)
+
+    def stop_handler(sig, frame):
+        """ called when SIGTERM received after the listener threads have been started """
+        logging.info("Received SIGTERM. Terminating")
+        mcs.stop()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop_handler)
+
+    # keep main thread alive, signal handlers are executed in the main thread
+    while True:
+        signal.pause()
@@ -1,13 +1,28 @@
+import json
 import logging
+import math
 import sys
 import signal
 import threading
 import time
 import paho.mqtt.client as mqtt
 from . import cul
+from .profiler import Profiler
+from .raw_fanout import RawFanout
+from .scheduler import Scheduler
 from .protocols import somfy_shutter, intertechno, lacrosse
 
 
+def section_options(config, name):
+    """
+    Options of a section without those inherited from DEFAULT, so a change of
+    DEFAULT doesn't reconfigure all components
+    """
+    defaults = config.defaults()
+    return {key: value for key, value in config.items(name, raw=True)
+            if key not in defaults or value != defaults[key]}
+
+
 class MQTT_CUL_Server:
     components = {}
 
@@ -15,19 +30,154 @@ class MQTT_CUL_Server:
         culdev = config.get("DEFAULT", "CUL", fallback="/dev/ttyACM0")
         baudrate = config.get("DEFAULT", "baud_rate", fallback="115200")
         self.cul = cul.Cul(culdev, int(baudrate))
+        # shared scheduler for timers of all components
+        self.scheduler = Scheduler()
         self.mqtt_client = self.get_mqtt_client(config)
         self.listenLoop = False
 
         # prefix for all MQTT topics
         self.prefix = config.get("DEFAULT", "prefix", fallback="homeassistant")
+        self.config = config
+        self.reload_lock = threading.Lock()
+
+        for name in ("intertechno", "somfy", "lacrosse"):
+            if config[name].getboolean("enabled"):
+                self.components[name] = self.create_component(name, config)
+
+        # CUL link health probe
+        self.link_topic = self.prefix + "/sensor/mqtt_cul_server/cul/state"
+        self.cul.on_status = self.publish_link_status
+        self.cul.on_reconnect = self.on_cul_reconnect
+        self.probe_interval = 0
+        self.probe_task = None
+
+        # optional fan-out of raw RF frames
+        self.raw_fanout = None
+        self.configure_raw_fanout(config)
+
+        # profiling, started by signal or admin topic. Result is written to statedir
+        self.profiler = Profiler(config.get("DEFAULT", "statedir", fallback="state"))
+        self.profile_topic = self.prefix + "/sensor/mqtt_cul_server/profile"
+
+        # check Somfy state directory for new, modified or removed files
+        self.reload_interval = 0
+        self.reload_task = None
+
+        self.configure_defaults(config)
+
+    def publish_link_status(self):
+        """Publish link status and round-trip time of CUL device"""
+        self.mqtt_client.publish(self.link_topic, payload=json.dumps(self.cul.get_link_status()), retain=True)
+
+    def on_cul_reconnect(self):
+        """Serial port has been reopened, CUL device may have been reset"""
+        for component in list(self.components.values()):
+            if hasattr(component, "on_cul_reconnect"):
+                component.on_cul_reconnect()
 
-        if config["intertechno"].getboolean("enabled"):
-            self.components["intertechno"] = intertechno.Intertechno(self.cul, self.mqtt_client, self.prefix, config["intertechno"])
-        if config["somfy"].getboolean("enabled"):
+    def create_component(self, name, config):
+        if name == "intertechno":
+            return intertechno.Intertechno(self.cul, self.mqtt_client, self.prefix, config["intertechno"], self.scheduler)
+        if name == "somfy":
             statedir = config.get("DEFAULT", "statedir", fallback="state")
-            self.components["somfy"] = somfy_shutter.SomfyShutter(self.cul, self.mqtt_client, self.prefix, statedir)
-        if config["lacrosse"].getboolean("enabled"):
-            self.components["lacrosse"] = lacrosse.LaCrosse(self.cul, self.mqtt_client, self.prefix)
+            return somfy_shutter.SomfyShutter(self.cul, self.mqtt_client, self.prefix, statedir, config["somfy"], self.scheduler)
+        if name == "lacrosse":
+            return lacrosse.LaCrosse(self.cul, self.mqtt_client, self.prefix, config["lacrosse"], self.scheduler)
+        raise ValueError(f"unknown component {name}")
+
+    def configure_defaults(self, config):
+        """
+        Apply options of section DEFAULT which can be changed at runtime:
+        link probe, profiler and periodic reload of the state directory
+        """
+        probe_interval = config.getfloat("DEFAULT", "probe_interval", fallback=60)
+        probe_timeout = config.getfloat("DEFAULT", "probe_timeout", fallback=5)
+        self.cul.probe_timeout = probe_timeout
+        if probe_interval != self.probe_interval:
+            if self.probe_task is not None:
+                self.probe_task.cancel()
+                self.probe_task = None
+            if probe_interval > 0:
+                self.probe_task = self.cul.start_probe(self.scheduler, probe_interval, probe_timeout)
+            self.probe_interval = probe_interval
+
+        self.profiler.outdir = config.get("DEFAULT", "statedir", fallback="state")
+        self.profiler.interval = config.getfloat("DEFAULT", "profile_interval", fallback=0.005)
+        self.profile_duration = config.getfloat("DEFAULT", "profile_duration", fallback=30)
+        self.profile_admin = config.getboolean("DEFAULT", "profile_admin", fallback=False)
+
+        reload_interval = config.getfloat("DEFAULT", "reload_interval", fallback=0)
+        if reload_interval != self.reload_interval:
+            if self.reload_task is not None:
+                self.reload_task.cancel()
+                self.reload_task = None
+            if reload_interval > 0:
+                self.reload_task = self.scheduler.call_every(reload_interval, self.reload_statedir)
+            self.reload_interval = reload_interval
+
+    def reload(self, config):
+        """
+        Apply changed configuration without restart. Components are created,
+        removed or reconfigured if their section has changed. Devices, timers and
+        transmit queues of unchanged components are kept.
+        CUL, MQTT and prefix settings can only be changed by a restart.
+        """
+        logging.info("Reloading configuration")
+        with self.reload_lock:
+            self.reload_config(config)
+        self.reload_statedir()
+
+    def reload_config(self, config):
+        """
+        Components can implement these methods for reload:
+        configure(section) applies the options of the component's section. It is
+            called on start and when the section has changed
+        close() cancels scheduled tasks and pending transmissions. It is called
+            before a disabled component is removed
+        """
+        for section, option in (("DEFAULT", "CUL"), ("DEFAULT", "baud_rate"), ("DEFAULT", "prefix")):
+            if config.get(section, option, fallback=None) != self.config.get(section, option, fallback=None):
+                logging.warning("Change of option %s requires a restart", option)
+        if section_options(config, "mqtt") != section_options(self.config, "mqtt"):
+            logging.warning("Change of section mqtt requires a restart")
+
+        for name in ("intertechno", "somfy", "lacrosse"):
+            component = self.components.get(name)
+            if not config[name].getboolean("enabled"):
+                if component is not None:
+                    logging.info("Component %s disabled", name)
+                    if hasattr(component, "close"):
+                        component.close()
+                    del self.components[name]
+            elif component is None:
+                logging.info("Component %s enabled", name)
+                self.components[name] = self.create_component(name, config)
+            elif section_options(config, name) != section_options(self.config, name) and hasattr(component, "configure"):
+                logging.info("Configuration of component %s changed", name)
+                component.configure(config[name])
+
+        self.configure_raw_fanout(config)
+        self.configure_defaults(config)
+        self.config = config
+        if "somfy" in self.components:
+            self.components["somfy"].statedir = config.get("DEFAULT", "statedir", fallback="state")
+
+    def configure_raw_fanout(self, config):
+        """ Create, remove or reconfigure raw frame fan-out according to section raw """
+        section = config["raw"] if config.has_section("raw") else config["DEFAULT"]
+        if not section.getboolean("enabled", fallback=False):
+            if self.raw_fanout is not None:
+                self.raw_fanout.flush()
+            self.raw_fanout = None
+        elif self.raw_fanout is None:
+            self.raw_fanout = RawFanout(self.mqtt_client, self.prefix, self.scheduler, section)
+        else:
+            self.raw_fanout.configure(section)
+
+    def reload_statedir(self):
+        with self.reload_lock:
+            if "somfy" in self.components:
+                self.components["somfy"].reload_devices()
 
     def get_mqtt_client(self, config):
         mqtt_client = mqtt.Client()
@@ -57,6 +207,17 @@ class MQTT_CUL_Server:
         """
         The callback for when a message is received
         """
+        if msg.topic == self.profile_topic + "/set" and self.profile_admin:
+            try:
+                duration = float(msg.payload.decode() or self.profile_duration)
+            except ValueError:
+                duration = None
+            if duration is None or not math.isfinite(duration) or duration <= 0:
+                logging.error("Invalid profile duration %s", msg.payload)
+                return
+            self.start_profile(duration)
+            return
+
         try:
             _, _, component, _ = msg.topic.split("/", 3)
         except ValueError:
@@ -78,15 +239,51 @@ class MQTT_CUL_Server:
         SOMFY: This function is also called when a command has been send to a device
         with the acknowledge message (same enc_key and rolling code)
         => Added a dummy message handler for Somfy.
+
+        message is passed as bytes, decoding is done by the protocol
+
+        Unhandled frames (or all frames, depending on configuration) are
+        published by the raw frame fan-out, if enabled.
         """
         if not message: return
-        if message[0:3] == "N01":
+        raw_fanout = self.raw_fanout
+        if raw_fanout is not None and raw_fanout.all:
+            raw_fanout.add(message)
+        if message[0:2] == b"N0" and "lacrosse" in self.components:
             self.components["lacrosse"].on_rf_message(message)
-        elif message[0:3] == "YsA":
+        elif message[0:3] == b"YsA" and "somfy" in self.components:
             self.components["somfy"].on_rf_message(message)
+        elif raw_fanout is not None:
+            if not raw_fanout.all:
+                raw_fanout.add(message)
         else:
             logging.error("Can't handle RF message: %s", message)
 
+    def start_profile(self, duration=None):
+        """
+        Profile all threads for duration seconds. Timing wrappers are installed
+        around the MQTT and RF message handlers while profiling.
+        """
+        if duration is None:
+            duration = self.profile_duration
+        if not self.profiler.start(duration, on_finish=self.stop_profile):
+            logging.warning("Profiling already running")
+            return
+        self.mqtt_client.on_message = self.profiler.timed(
+            "on_mqtt_message", self.on_mqtt_message, key=lambda _c, _u, msg: msg.topic.split("/", 3)[2] if msg.topic.count("/") >= 2 else "")
+        self.cul.callback = self.profiler.timed(
+            "on_rf_message", self.on_rf_message, key=lambda message: message[0:3].decode("ascii", "replace"))
+
+    def stop_profile(self, filename):
+        """ Called by profiler when done. Remove timing wrappers and publish result """
+        self.mqtt_client.on_message = self.on_mqtt_message
+        self.cul.callback = self.on_rf_message
+        result = {
+            "file": filename,
+            "handlers": {name: histogram.as_dict() for name, histogram in self.profiler.handlers.items()},
+        }
+        self.mqtt_client.publish(self.profile_topic + "/state", payload=json.dumps(result), retain=False)
+
     def loop(self):
         """
         Listen for MQTT command messages
@@ -105,11 +302,22 @@ class MQTT_CUL_Server:
         Start multiple threads to listen for MQTT and RF messages
         """
         # thread to listen for MQTT command messages
-        self.mqtt_listener = threading.Thread(target=self.mqtt_client.loop_forever)
+        self.mqtt_listener = threading.Thread(target=self.mqtt_client.loop_forever, daemon=True)
         # if CPU load is too high, comment the previous line and uncomment the following line
-        # self.mqtt_listener = threading.Thread(target=self.loop)        
+        # self.mqtt_listener = threading.Thread(target=self.loop, daemon=True)
         self.mqtt_listener.start()
         # thread to listen for received RF messages
-        self.cul_listener = threading.Thread(target=self.cul.listen, args=[self.on_rf_message])
+        self.cul_listener = threading.Thread(target=self.cul.listen, args=[self.on_rf_message], daemon=True)
         self.cul_listener.start()
+
+    def stop(self, timeout=5):
+        """
+        Stop listener threads. Waits up to timeout seconds for each thread,
+        the CUL listener may be waiting between reconnect attempts
+        """
+        self.listenLoop = False
+        self.cul.exit_loop = True
+        self.mqtt_client.disconnect()
+        for thread in (self.mqtt_listener, self.cul_listener):
+            thread.join(timeout)
         
\ No newline at end of file
@@ -2,8 +2,17 @@ import sys
 import logging
 import os
 import serial
+import threading
 import time
 
+from .metrics import Histogram
+
+# maximum wait time in seconds between attempts to reopen the serial port
+MAX_RECONNECT_DELAY = 60
+
+# maximum length of a received line. Longer data without newline is discarded
+MAX_LINE_LENGTH = 1024
+
 class Cul(object):
     """Helper class to encapsulate serial communication with CUL device"""
 
@@ -11,59 +20,247 @@ class Cul(object):
         """
         Create instance with a given serial port
         """
-        
+
         self.exit_loop = False
-        
+
+        # serialize writes from MQTT thread and timer threads
+        self.tx_lock = threading.Lock()
+
+        """
+        Link health
+
+        A version request is sent periodically (see start_probe) and the round-trip
+        time of the answer is measured. If there's no answer or the serial port
+        fails, the port is reopened by the listener thread.
+        """
+        self.serial_port = serial_port
+        self.baud_rate = baud_rate
+        self.connected = False
+        self.reconnect_requested = False
+        self.version = None
+        self.probe_time = None      # time of unanswered version request
+        self.probe_timeout = 5
+        self.rtt = Histogram(bounds=(5, 10, 25, 50, 100, 250, 500))
+        self.last_rtt = None
+        self.stats = { "reconnects": 0, "stalls": 0, "errors": 0 }
+        self.on_status = None       # called when link status or RTT changes
+        self.on_reconnect = None    # called after the serial port has been reopened
+
+        # time of last command causing a RF transmission
+        self.last_rf_tx = 0
+
+        # received bytes of incomplete line
+        self.rx_buffer = bytearray()
+
+        # handler for received messages, set by listen(). Can be replaced at runtime
+        self.callback = None
+
         if test:
             self.serial = sys.stderr
             self.test = True
+            self.connected = True
         else:
             self.test = False
             if not os.path.exists(serial_port):
                 raise ValueError("cannot find CUL device %s" % serial_port)
-            try:
-                self.serial = serial.Serial(
-                    port=serial_port, baudrate=baud_rate, timeout=1
-                )
-            except serial.SerialException as e:
-                logging.error("Could not open CUL device: %s", e)
+            self.open()
+
+    def open(self):
+        """Open serial port. Returns True on success"""
+        try:
+            self.serial = serial.Serial(
+                port=self.serial_port, baudrate=self.baud_rate, timeout=1
+            )
+        except serial.SerialException as e:
+            logging.error("Could not open CUL device: %s", e)
+            return False
+        self.set_connected(True)
+        return True
+
+    def set_connected(self, connected):
+        if connected != self.connected:
+            self.connected = connected
+            if self.on_status is not None:
+                self.on_status()
+
+    def reconnect(self):
+        """
+        Close and reopen serial port. Called by listener thread.
+        Waits with exponential backoff between failed attempts.
+        """
+        self.reconnect_requested = False
+        self.probe_time = None
+        self.rx_buffer.clear()
+        self.set_connected(False)
+        try:
+            self.serial.close()
+        except (AttributeError, OSError, serial.SerialException):
+            pass
+
+        delay = 1
+        while not self.exit_loop:
+            if os.path.exists(self.serial_port) and self.open():
+                self.stats["reconnects"] += 1
+                logging.info("Reconnected to CUL device %s", self.serial_port)
+                if self.on_reconnect is not None:
+                    self.on_reconnect()
+                return
+            logging.info("Retrying to open CUL device in %d seconds", delay)
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def start_probe(self, scheduler, interval, timeout=5):
+        """
+        Send version request every interval seconds, reconnect if not answered within timeout.
+        Returns the scheduled task
+        """
+        self.probe_timeout = timeout
+        return scheduler.call_every(interval, self.probe, scheduler)
+
+    def probe(self, scheduler):
+        """Send version request through the transmit path"""
+        if not self.connected or self.probe_time is not None:
+            return
+        self.probe_time = time.monotonic()
+        self.send_command(b"V\n", rf=False)
+        scheduler.call_later(self.probe_timeout, self.check_probe, self.probe_time)
+
+    def check_probe(self, probe_time):
+        """Called probe_timeout seconds after sending the version request"""
+        if self.probe_time != probe_time:
+            return
+        logging.error("CUL device did not answer within %.1f seconds. Reconnecting", self.probe_timeout)
+        self.stats["stalls"] += 1
+        self.probe_time = None
+        self.reconnect_requested = True
+
+    def handle_version(self, message):
+        """Answer to version request received"""
+        self.version = message.strip()
+        if self.probe_time is not None:
+            self.last_rtt = (time.monotonic() - self.probe_time) * 1000
+            self.rtt.observe(self.last_rtt)
+            self.probe_time = None
+            logging.debug("CUL version %s, round-trip time %.1f ms", self.version, self.last_rtt)
+        if self.on_status is not None:
+            self.on_status()
 
     def get_cul_version(self):
-        """Get CUL version"""
-        self.serial.write("V\n")
-        self.serial.flush()
-        version = self.serial.readline()
-        return version
-
-    def send_command(self, command_string):
-        """Send command string to serial port with CUL device"""
+        """Get CUL version as received on the last version request"""
+        return self.version
+
+    def get_link_status(self):
+        """Link status, version, round-trip time and error counters"""
+        return {
+            "status": "online" if self.connected else "offline",
+            "version": self.version,
+            "rtt_ms": None if self.last_rtt is None else round(self.last_rtt, 1),
+            "rtt_histogram_ms": self.rtt.as_dict(),
+            **self.stats,
+        }
+
+    def send_command(self, command_string, rf=True):
+        """
+        Send command string to serial port with CUL device.
+        rf=False for commands which don't cause a RF transmission
+        """
+        if rf:
+            self.last_rf_tx = time.monotonic()
         if self.test:
             print(command_string.decode())
         else:
+            if not self.connected:
+                logging.error("CUL device not connected. Dropping command %s", command_string)
+                return
             try:
-                self.serial.write(command_string)
+                with self.tx_lock:
+                    self.serial.write(command_string)
 
-                # FIXME: this is lacrosse-specific and should not be in this class
-                # self.serial.write(b"Nr1\n")
+                    # FIXME: this is lacrosse-specific and should not be in this class
+                    # self.serial.write(b"Nr1\n")
 
-                self.serial.flush()
-            except serial.SerialException as e:
+                    self.serial.flush()
+            except (serial.SerialException, OSError) as e:
                 logging.error("Could not send command to CUL device %s", e)
-                sys.exit(1)
+                self.stats["errors"] += 1
+                self.reconnect_requested = True
+
+    def feed(self, data, callback):
+        """
+        Append received bytes to buffer and dispatch all complete lines.
+        Lines are passed as bytes without line ending, decoding is up to the
+        protocol handling the message. Answers to version requests and numeric
+        command replies are consumed here.
+        """
+        buffer = self.rx_buffer
+        buffer += data
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            message = bytes(memoryview(buffer)[start:end]).rstrip(b"\r")
+            start = end + 1
+            if not message:
+                continue
+            logging.debug("Received RF message: %s", message)
+            try:
+                if message.startswith(b"V "):
+                    self.handle_version(message.decode("ascii", "replace"))
+                elif message.isdigit():
+                    # answer to a settings command, e.g. repetition count of "isr"
+                    logging.debug("Received command reply %s", message)
+                else:
+                    callback(message)
+            except Exception:
+                logging.exception("Error handling RF message %s", message)
+        del buffer[:start]
+        if len(buffer) > MAX_LINE_LENGTH:
+            logging.warning("Discarding %d bytes without line ending", len(buffer))
+            buffer.clear()
 
     def listen(self, callback):
         """
         Listen for RF messages
         """
+        self.callback = callback
         while not self.exit_loop:
+            if not self.connected or self.reconnect_requested:
+                self.reconnect()
+                continue
             try:
-                # readline() blocks until message is available or timeout of 1s happens
-                message = self.serial.readline().decode("utf-8")
-                if message:
-                    logging.debug("Received RF message: %s", message)
-                callback(message)
-            except:
-                pass
-            
-            # Wait 100ms before calling readline() again. Prevent high CPU load!
-            time.sleep(0.1)
+                # read() blocks until at least one byte is available or timeout of 1s
+                # happens, then all bytes already waiting are read with one call
+                data = self.serial.read(max(1, self.serial.in_waiting))
+            except (serial.SerialException, OSError) as e:
+                logging.error("Could not read from CUL device: %s", e)
+                self.stats["errors"] += 1
+                self.reconnect_requested = True
+                continue
+            if data:
+                self.feed(data, self.callback)
+
+def test_probe():
+    from .scheduler import Scheduler
+
+    cul = Cul("", test=True)
+    scheduler = Scheduler()
+    cul.probe_timeout = 0.05
+    cul.probe(scheduler)
+    cul.handle_version("V 1.67 CUL868\r\n")
+    assert cul.get_cul_version() == "V 1.67 CUL868"
+    assert cul.rtt.count == 1
+    cul.probe(scheduler)
+    time.sleep(0.15)
+    assert cul.reconnect_requested
+    assert cul.get_link_status()["stalls"] == 1
+
+def test_feed():
+    cul = Cul("", test=True)
+    messages = []
+    cul.feed(b"N0199E6282EC7AAAA0000719199\r\nYsA1", messages.append)
+    assert messages == [b"N0199E6282EC7AAAA0000719199"]
+    cul.feed(b"2F101CB0C004\r\n\xff\xfe\r\nV 1.67 CUL868\r\n3\r\n", messages.append)
+    assert messages[1:] == [b"YsA12F101CB0C004", b"\xff\xfe"]
+    assert cul.get_cul_version() == "V 1.67 CUL868"
+    assert not cul.rx_buffer
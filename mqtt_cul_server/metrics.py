@@ -0,0 +1,62 @@
+"""
+Simple metrics helpers for values published on the stats topics
+"""
+
+import threading
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket bounds, e.g. for latencies in ms
+
+    as_dict() returns a JSON serializable dict with count, sum, min, max,
+    average and the number of observations per bucket ("le_<bound>" and "inf")
+    """
+
+    def __init__(self, bounds=(25, 50, 100, 250, 500, 1000, 2500)):
+        self.bounds = tuple(bounds)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buckets = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.min = None
+            self.max = None
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.bounds):
+                if value <= bound:
+                    self.buckets[i] += 1
+                    break
+            else:
+                self.buckets[-1] += 1
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self):
+        with self.lock:
+            result = {
+                "count": self.count,
+                "avg": round(self.sum / self.count, 1) if self.count else None,
+                "min": None if self.min is None else round(self.min, 1),
+                "max": None if self.max is None else round(self.max, 1),
+            }
+            for bound, count in zip(self.bounds, self.buckets):
+                result["le_" + str(bound)] = count
+            result["inf"] = self.buckets[-1]
+        return result
+
+
+def test_histogram():
+    histogram = Histogram(bounds=(10, 100))
+    for value in (5, 10, 50, 500):
+        histogram.observe(value)
+    assert histogram.as_dict() == {
+        "count": 4, "avg": 141.2, "min": 5, "max": 500, "le_10": 2, "le_100": 1, "inf": 1
+    }
@@ -0,0 +1,158 @@
+"""
+Runtime profiler
+
+Samples the stacks of all threads for a given time and measures the run
+time of the message handlers. Handler timing is done by wrappers which are
+only installed while profiling, so there is no overhead otherwise.
+The result is written to a text file with the handler timings, the
+functions using most of the time and the sampled stacks in collapsed format
+(one line per stack, can be converted to a flame graph).
+"""
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+from .metrics import Histogram
+
+# maximum number of frames per sampled stack
+MAX_DEPTH = 64
+
+# number of functions listed in the summary
+TOP_FUNCTIONS = 30
+
+# maximum profiling time in seconds
+MAX_DURATION = 600
+
+
+class Profiler:
+    """Sampling profiler for all threads, toggled at runtime"""
+
+    def __init__(self, outdir, interval=0.005):
+        self.outdir = outdir
+        self.interval = interval
+        self.thread = None
+        self.stacks = collections.Counter()
+        self.handlers = {}          # handler name -> Histogram of run times in ms
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration, on_finish=None):
+        """
+        Start profiling for duration seconds, at most MAX_DURATION. on_finish is
+        called with the name of the result file. Returns False if profiling is
+        already running.
+        """
+        if self.is_running():
+            return False
+        duration = min(duration, MAX_DURATION)
+        self.stacks = collections.Counter()
+        self.handlers = {}
+        self.thread = threading.Thread(target=self.run, args=[duration, on_finish], name="profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def timed(self, name, func, key=None):
+        """
+        Return wrapper of func measuring its run time. key is called with
+        the arguments of func and returns a suffix for the handler name.
+        """
+        def wrapper(*args):
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000
+                handler = name if key is None else name + "[" + str(key(*args)) + "]"
+                histogram = self.handlers.get(handler)
+                if histogram is None:
+                    histogram = self.handlers.setdefault(handler, Histogram(bounds=(0.1, 0.5, 1, 5, 10, 50, 100)))
+                histogram.observe(elapsed)
+        return wrapper
+
+    def sample(self):
+        """Record current stack of each thread except the profiler itself"""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def run(self, duration, on_finish):
+        logging.info("Profiling for %d seconds", duration)
+        end = time.monotonic() + duration
+        samples = 0
+        while time.monotonic() < end:
+            self.sample()
+            samples += 1
+            time.sleep(self.interval)
+        filename = None
+        try:
+            filename = self.write(duration, samples)
+            logging.info("Profile written to %s", filename)
+        except OSError as e:
+            logging.error("Cannot write profile: %s", e)
+        if on_finish is not None:
+            on_finish(filename)
+
+    def summary(self):
+        """Count of samples per function: (self, cumulative)"""
+        own = collections.Counter()
+        cumulative = collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                own[frames[-1]] += count
+            for function in set(frames):
+                cumulative[function] += count
+        return own, cumulative
+
+    def write(self, duration, samples):
+        filename = os.path.join(self.outdir, time.strftime("profile-%Y%m%d-%H%M%S.txt"))
+        own, cumulative = self.summary()
+        with open(filename, "w", encoding='utf8') as file_handle:
+            file_handle.write(f"# {duration} seconds, {samples} samples every {self.interval * 1000:.1f} ms\n")
+            file_handle.write("\n# handler run times in ms\n")
+            for handler, histogram in sorted(self.handlers.items()):
+                stats = histogram.as_dict()
+                file_handle.write(f"{handler}: count={stats['count']} avg={stats['avg']} max={stats['max']} "
+                                  f"total={histogram.sum:.1f}\n")
+            file_handle.write("\n# samples (self, cumulative) per function\n")
+            for function, count in cumulative.most_common(TOP_FUNCTIONS):
+                file_handle.write(f"{own[function]:8d} {count:8d}  {function}\n")
+            file_handle.write("\n# collapsed stacks\n")
+            for stack, count in self.stacks.most_common():
+                file_handle.write(f"{stack} {count}\n")
+        return filename
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler(str(tmp_path), interval=0.001)
+    results = []
+    handler = profiler.timed("handler", time.sleep, key=lambda seconds: "sleep")
+
+    def busy():
+        while not results:
+            handler(0.001)
+
+    worker = threading.Thread(target=busy, name="worker")
+    worker.start()
+    assert profiler.start(0.1, results.append)
+    assert not profiler.start(float("inf"))
+    profiler.thread.join()
+    worker.join()
+    with open(results[0], encoding='utf8') as file_handle:
+        content = file_handle.read()
+    assert "handler[sleep]: count=" in content
+    assert "worker;" in content
@@ -8,6 +8,18 @@ wireless communication protocol.
 import json
 import logging
 import re
+import threading
+import time
+
+# culfw sends each Intertechno frame 6 times unless changed with "isr"
+CULFW_DEFAULT_REPEATS = 6
+
+# each system can have exactly these 5 units
+UNIT_IDS = ["0FFFF", "F0FFF", "FF0FF", "FFF0F", "FFFF0"]
+
+# Airtime of one frame repetition in ms: 12 tri-state bits of 8 pulse
+# periods plus 32 periods sync pause, 420 us per period
+FRAME_AIRTIME_MS = 128 * 0.42
 
 
 class Intertechno:
@@ -18,14 +30,63 @@ class Intertechno:
     wireless communication protocol.
     """
 
-    def __init__(self, cul, mqtt_client, prefix, config):
+    def __init__(self, cul, mqtt_client, prefix, config, scheduler):
         self.cul = cul
+        self.mqtt_client = mqtt_client
+        self.scheduler = scheduler
 
-        self.system_id = config["system_id"]
+        self.system_id = None
         self.prefix = prefix
 
+        self.lock = threading.Lock()
+        self.pending = {}        # devicename -> (commandbits, scheduled flush task)
+        self.last_sent = {}      # devicename -> (commandbits, timestamp)
+        self.cul_repeats = CULFW_DEFAULT_REPEATS
+        self.stats = {
+            "sent": 0,
+            "coalesced": 0,
+            "skipped": 0,
+            "airtime_ms": 0.0,
+            "airtime_saved_ms": 0.0,
+        }
+        self.stats_topic = self.prefix + "/sensor/mqtt_cul_server/intertechno/stats"
+
+        self.configure(config)
+
+    def configure(self, config):
+        """
+        Set coalescing, skip and repeat options. Pending commands and the
+        repetition count of the CUL are kept. Discovery is sent again if the
+        system ID has changed.
+        """
+        system_id = config["system_id"]
+        self.config = config
+
+        """
+        Airtime saving
+
+        coalesce_window: seconds to wait for further commands to the same
+            device. Only the last command in the window is sent (0 = send
+            immediately)
+        skip_ttl: seconds during which a command is not sent again if it
+            matches the last command sent to the device (0 = never skip)
+        repeats / repeats_<unit_id>: number of frame repetitions
+        """
+        self.coalesce_window = config.getfloat("coalesce_window", fallback=0)
+        self.skip_ttl = config.getfloat("skip_ttl", fallback=0)
+        self.repeats = config.getint("repeats", fallback=CULFW_DEFAULT_REPEATS)
+
+        if system_id == self.system_id:
+            return
+        if self.system_id is not None:
+            logging.info("Intertechno system ID changed from %s to %s", self.system_id, system_id)
+            if self.mqtt_client is not None:
+                self.remove_discovery(self.mqtt_client)
+        self.system_id = system_id
+
         # send messages for device discovery
-        self.send_discovery(mqtt_client)
+        if self.mqtt_client is not None:
+            self.send_discovery(self.mqtt_client)
 
     @classmethod
     def get_component_name(cls):
@@ -43,9 +104,6 @@ class Intertechno:
         feedback about the state.
         """
 
-        # each system can have exactly these 5 units
-        unit_ids = ["0FFFF", "F0FFF", "FF0FF", "FFF0F", "FFFF0"]
-
         configuration = {
             "command_topic": "~/set",
             "payload_on": "ON",
@@ -53,7 +111,7 @@ class Intertechno:
             "optimistic": True,
         }
 
-        for unit_id in unit_ids:
+        for unit_id in UNIT_IDS:
             base_prefix = (
                 self.prefix + "/switch/intertechno/" + self.system_id + unit_id
             )
@@ -64,6 +122,12 @@ class Intertechno:
             topic = base_prefix + "/config"
             mqtt_client.publish(topic, payload=json.dumps(configuration), retain=True)
 
+    def remove_discovery(self, mqtt_client):
+        """Remove switches of current system ID by publishing empty configurations"""
+        for unit_id in UNIT_IDS:
+            topic = self.prefix + "/switch/intertechno/" + self.system_id + unit_id + "/config"
+            mqtt_client.publish(topic, payload="", retain=True)
+
     def on_message(self, message):
         prefix, devicetype, component, devicename, topic = message.topic.split("/", 4)
         command = message.payload.decode()
@@ -90,13 +154,123 @@ class Intertechno:
             else:
                 raise ValueError("Command %s is not supported", command)
 
-            command = "is" + devicename + commandbits + "\n"
-            self.send_command(command)
+            self.queue_command(devicename, commandbits)
         else:
             logging.debug("ignoring topic %s", topic)
 
+    def on_cul_reconnect(self):
+        """Repetition count of CUL is unknown after reconnect, send it with next command"""
+        with self.lock:
+            self.cul_repeats = None
+
+    def close(self):
+        """Cancel pending coalesced commands without sending them"""
+        with self.lock:
+            for _, task in self.pending.values():
+                task.cancel()
+            self.pending.clear()
+
+    def get_repeats(self, devicename):
+        """Number of frame repetitions for a device (system_id + unit_id)"""
+        return self.config.getint("repeats_" + devicename[5:], fallback=self.repeats)
+
+    def queue_command(self, devicename, commandbits):
+        """
+        Send command now or after the coalescing window. A command queued
+        for the same device during the window replaces the pending one.
+        """
+        with self.lock:
+            if self.coalesce_window <= 0:
+                self.transmit(devicename, commandbits)
+                return
+
+            if devicename in self.pending:
+                _, task = self.pending[devicename]
+                task.cancel()
+                self.stats["coalesced"] += 1
+                self.stats["airtime_saved_ms"] += self.get_repeats(devicename) * FRAME_AIRTIME_MS
+                logging.debug("replacing pending command for device %s", devicename)
+
+            task = self.scheduler.call_later(self.coalesce_window, self.flush, devicename)
+            self.pending[devicename] = (commandbits, task)
+
+    def flush(self, devicename):
+        """Timer function called when the coalescing window has expired"""
+        with self.lock:
+            if devicename not in self.pending:
+                return
+            commandbits, _ = self.pending.pop(devicename)
+            self.transmit(devicename, commandbits)
+
+    def transmit(self, devicename, commandbits):
+        """Build and send command string. Caller must hold self.lock"""
+        now = time.monotonic()
+        repeats = self.get_repeats(devicename)
+
+        last = self.last_sent.get(devicename)
+        if self.skip_ttl > 0 and last is not None and last[0] == commandbits and now - last[1] < self.skip_ttl:
+            logging.debug("device %s already in requested state. Skipping command", devicename)
+            self.stats["skipped"] += 1
+            self.stats["airtime_saved_ms"] += repeats * FRAME_AIRTIME_MS
+            self.publish_stats()
+            return
+
+        command = ""
+        if repeats != self.cul_repeats:
+            # set repetition count of culfw, stays active for following commands.
+            # culfw answers with the count, the reply is consumed by Cul.feed
+            command = "isr" + str(repeats) + "\n"
+            self.cul_repeats = repeats
+        command += "is" + devicename + commandbits + "\n"
+        self.send_command(command)
+
+        self.last_sent[devicename] = (commandbits, now)
+        self.stats["sent"] += 1
+        self.stats["airtime_ms"] += repeats * FRAME_AIRTIME_MS
+        self.publish_stats()
+
+    def publish_stats(self):
+        """Publish transmit counters and airtime"""
+        if self.mqtt_client is None:
+            return
+        stats = dict(self.stats)
+        stats["airtime_ms"] = round(stats["airtime_ms"], 1)
+        stats["airtime_saved_ms"] = round(stats["airtime_saved_ms"], 1)
+        self.mqtt_client.publish(self.stats_topic, payload=json.dumps(stats), retain=False)
+
     def send_command(self, command):
         """Send command string via CUL device"""
         command_string = command.encode()
         logging.debug("sending intertechno command %s", command)
         self.cul.send_command(command_string)
+
+
+def test_send_immediately(make_intertechno, capsys):
+    intertechno = make_intertechno()
+    intertechno.queue_command("0F0FF0FFFF", "FF")
+    assert capsys.readouterr().out == "is0F0FF0FFFFFF\n\n"
+    assert intertechno.stats["sent"] == 1
+
+def test_coalesce(make_intertechno, capsys):
+    intertechno = make_intertechno(coalesce_window="0.05")
+    intertechno.queue_command("0F0FF0FFFF", "FF")
+    intertechno.queue_command("0F0FF0FFFF", "F0")
+    intertechno.queue_command("0F0FF0FFFF", "FF")
+    time.sleep(0.2)
+    assert capsys.readouterr().out == "is0F0FF0FFFFFF\n\n"
+    assert intertechno.stats["sent"] == 1
+    assert intertechno.stats["coalesced"] == 2
+    assert intertechno.stats["airtime_saved_ms"] == 2 * CULFW_DEFAULT_REPEATS * FRAME_AIRTIME_MS
+
+    intertechno.queue_command("0F0FF0FFFF", "F0")
+    intertechno.close()
+    time.sleep(0.1)
+    assert capsys.readouterr().out == ""
+
+def test_skip_and_repeats(make_intertechno, capsys):
+    intertechno = make_intertechno(skip_ttl="60", repeats_F0FFF="3")
+    intertechno.queue_command("0F0FFF0FFF", "FF")
+    intertechno.queue_command("0F0FFF0FFF", "FF")
+    intertechno.queue_command("0F0FF0FFFF", "FF")
+    assert capsys.readouterr().out == "isr3\nis0F0FFF0FFFFF\n\nisr6\nis0F0FF0FFFFFF\n\n"
+    assert intertechno.stats["skipped"] == 1
@@ -1,8 +1,125 @@
+import configparser
 import json
 import logging
+import math
+import struct
+import threading
+import time
+
+from array import array
 
 from .. import cul
 
+# smoothing factor for learning the frame rate of receive modes
+RATE_ALPHA = 0.3
+
+"""
+Compact state payload, little endian:
+  sensor id (uint8), temperature in 0.1 °C (int16), humidity in % (uint8,
+  255 = no humidity sensor), battery in % (uint8)
+"""
+COMPACT_STATE = struct.Struct("<BhBB")
+COMPACT_NO_HUMIDITY = 255
+
+
+def compute_shares(rates, min_share):
+    """
+    Share of receive time for each mode. Each mode gets at least min_share,
+    the remaining time is distributed proportionally to the frame rates.
+    """
+    free = max(1 - len(rates) * min_share, 0)
+    total = sum(rates.values())
+    return {
+        mode: min_share + (free * rate / total if total > 0 else free / len(rates))
+        for mode, rate in rates.items()
+    }
+
+
+class LaCrosseReading:
+    """Decoded values of one LaCrosse frame. humidity is None if the sensor has none"""
+    __slots__ = ("id", "temperature", "humidity", "battery")
+
+    def __init__(self, sensor_id, temperature, humidity, battery):
+        self.id = sensor_id
+        self.temperature = temperature
+        self.humidity = humidity
+        self.battery = battery
+
+    def as_dict(self):
+        result = {"id": self.id, "temperature": self.temperature}
+        if self.humidity is not None:
+            result["humidity"] = self.humidity
+        result["battery"] = self.battery
+        return result
+
+    def state_payload(self):
+        """JSON payload for state topic, same as json.dumps of as_dict() without id"""
+        if self.humidity is None:
+            return '{"temperature": %r, "battery": %d}' % (self.temperature, self.battery)
+        return '{"temperature": %r, "humidity": %d, "battery": %d}' % (self.temperature, self.humidity, self.battery)
+
+    def compact_payload(self):
+        """Binary payload for compact topic, see COMPACT_STATE"""
+        humidity = COMPACT_NO_HUMIDITY if self.humidity is None else self.humidity
+        return COMPACT_STATE.pack(self.id, round(self.temperature * 10), humidity, self.battery)
+
+
+def decode_compact_payload(payload):
+    """Decode payload of compact topic. Returns LaCrosseReading"""
+    sensor_id, temperature, humidity, battery = COMPACT_STATE.unpack(payload)
+    return LaCrosseReading(sensor_id, temperature / 10,
+                           None if humidity == COMPACT_NO_HUMIDITY else humidity, battery)
+
+
+class SensorTopics:
+    """MQTT topics of a sensor, built once instead of for every frame"""
+    __slots__ = ("base", "state", "compact", "aggregate")
+
+    def __init__(self, prefix, sensor_id):
+        self.base = prefix + "/sensor/lacrosse/" + str(sensor_id)
+        self.state = self.base + "/state"
+        self.compact = self.base + "/compact"
+        self.aggregate = self.base + "/aggregate"
+
+
+class SensorWindow:
+    """
+    Fixed-size ring buffer of temperature and humidity samples of one sensor.
+    Missing humidity is stored as NaN. If more samples than size are added
+    within one window, the oldest ones are overwritten.
+    """
+    __slots__ = ("size", "temperature", "humidity", "index", "count", "battery")
+
+    def __init__(self, size):
+        self.size = size
+        self.temperature = array("f", bytes(4 * size))
+        self.humidity = array("f", bytes(4 * size))
+        self.index = 0
+        self.count = 0
+        self.battery = None
+
+    def add(self, temperature, humidity, battery):
+        self.temperature[self.index] = temperature
+        self.humidity[self.index] = math.nan if humidity is None else humidity
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.battery = battery
+
+    def aggregate(self):
+        """Return min / max / mean of the window and start a new window"""
+        result = {"count": self.count, "battery": self.battery}
+        for name, values in (("temperature", self.temperature), ("humidity", self.humidity)):
+            samples = [v for v in values[:self.count] if not math.isnan(v)]
+            if samples:
+                result[name] = {
+                    "min": round(min(samples), 1),
+                    "max": round(max(samples), 1),
+                    "mean": round(sum(samples) / len(samples), 1),
+                }
+        self.index = 0
+        self.count = 0
+        return result
+
 
 class LaCrosse:
     """
@@ -17,24 +134,145 @@ class LaCrosse:
 
     """
 
-    def __init__(self, cul, mqtt_client, prefix):
+    def __init__(self, cul, mqtt_client, prefix, config=None, scheduler=None):
         self.cul = cul
         self.prefix = prefix
         self.mqtt_client = mqtt_client
-        self.devices = []
+        self.scheduler = scheduler
+        self.devices = set()
+        self.topics = {}            # sensor id -> SensorTopics
+
+        self.lock = threading.Lock()
+        self.windows = {}           # sensor id -> SensorWindow
+        self.window_size = 0
+        self.aggregate_task = None
+
+        self.modes = []
+        self.mode = None            # current receive mode
+        self.mode_pos = 0
+        self.mode_task = None
+        self.closed = False         # set by close(), switch_mode doesn't reschedule
+        self.mode_rates = {}        # mode -> learned frames per second
+        self.shares = {}            # mode -> share of cycle_time
+        self.slot_start = 0
+        self.slot_frames = 0
+
+        if config is None:
+            config = configparser.ConfigParser()["DEFAULT"]
+        self.configure(config)
+
+    def configure(self, config):
+        """
+        Restart the aggregate task and the mode cycle with the first mode and
+        send Nr again. Sample windows are cleared if window_size has changed,
+        learned frame rates if modes have changed.
+
+        raw: publish every received value on the state topic
+        compact: publish every received value in binary format on the compact topic
+        aggregate_interval: seconds between publishing min / max / mean on the
+            aggregate topic (0 = disabled)
+        window_size: maximum number of samples per sensor and window
+        modes: culfw native receive modes (1 = 17.241 kbps, 2 = 9.579 kbps,
+            3 = 8.842 kbps). With more than one mode, modes are switched in
+            time slices, weighted by the number of received frames
+        cycle_time: seconds for one cycle through all modes
+        min_share: minimum share of cycle_time for each mode
+        tx_guard: seconds to wait after a RF transmission before switching mode
+        """
+        self.raw = config.getboolean("raw", fallback=True)
+        self.compact = config.getboolean("compact", fallback=False)
+        aggregate_interval = config.getfloat("aggregate_interval", fallback=0)
+        window_size = config.getint("window_size", fallback=64)
+        if window_size < 1:
+            logging.error("Invalid LaCrosse window_size %d. Using 64", window_size)
+            window_size = 64
+
+        with self.lock:
+            if self.aggregate_task is not None:
+                self.aggregate_task.cancel()
+                self.aggregate_task = None
+            if window_size != self.window_size:
+                self.windows = {}
+            self.window_size = window_size
+            self.aggregate_interval = aggregate_interval
+            if aggregate_interval > 0 and self.scheduler is not None:
+                self.aggregate_task = self.scheduler.call_every(aggregate_interval, self.publish_aggregates)
+
+        modes = [int(m) for m in config.get("modes", fallback="1").split(",")]
+        self.cycle_time = config.getfloat("cycle_time", fallback=60)
+        self.min_share = config.getfloat("min_share", fallback=0.1)
+        self.tx_guard = config.getfloat("tx_guard", fallback=1)
+
+        with self.lock:
+            if self.mode_task is not None:
+                self.mode_task.cancel()
+                self.mode_task = None
+            if modes != self.modes:
+                self.modes = modes
+                self.mode_rates = {mode: 0.0 for mode in modes}
+                self.shares = compute_shares(self.mode_rates, self.min_share)
+            self.mode_pos = 0
+            self.mode = modes[0]
+            self.slot_start = time.monotonic()
+            self.slot_frames = 0
+            if len(modes) > 1 and self.scheduler is not None:
+                self.mode_task = self.scheduler.call_later(
+                    self.shares[self.mode] * self.cycle_time, self.switch_mode)
         self.set_listening_mode()
 
+    def close(self):
+        """Cancel aggregate and mode switch tasks, a running switch_mode doesn't reschedule"""
+        with self.lock:
+            self.closed = True
+            for task in (self.aggregate_task, self.mode_task):
+                if task is not None:
+                    task.cancel()
+            self.aggregate_task = None
+            self.mode_task = None
+
     @classmethod
     def get_component_name(cls):
         return "lacrosse"
 
     def set_listening_mode(self):
-        """Enable listening for Native RF mode 1"""
-        command_string = "Nr1\n".encode()
-        self.cul.send_command(command_string)
+        """Enable listening for current Native RF mode"""
+        # prefix of frames received in current mode
+        self.mode_prefix = ("N0" + str(self.mode)).encode()
+        command_string = ("Nr" + str(self.mode) + "\n").encode()
+        self.cul.send_command(command_string, rf=False)
 
+    def switch_mode(self):
+        """
+        Scheduler task called at the end of a time slice. Learn frame rate of the
+        current mode and switch to the next one. The switch is delayed if a RF
+        transmission has been started within tx_guard seconds.
+        """
+        now = time.monotonic()
+        guard_end = self.cul.last_rf_tx + self.tx_guard
+        with self.lock:
+            if self.closed:
+                return
+            if now < guard_end:
+                self.mode_task = self.scheduler.call_later(guard_end - now, self.switch_mode)
+                return
+
+            rate = self.slot_frames / max(now - self.slot_start, 0.001)
+            self.mode_rates[self.mode] = RATE_ALPHA * rate + (1 - RATE_ALPHA) * self.mode_rates[self.mode]
+            self.mode_pos = (self.mode_pos + 1) % len(self.modes)
+            if self.mode_pos == 0:
+                self.shares = compute_shares(self.mode_rates, self.min_share)
+                logging.debug("LaCrosse receive mode shares: %s", self.shares)
+            self.mode = self.modes[self.mode_pos]
+            self.slot_start = now
+            self.slot_frames = 0
+            self.mode_task = self.scheduler.call_later(self.shares[self.mode] * self.cycle_time, self.switch_mode)
+        self.set_listening_mode()
 
-    def send_discovery(self, parsed_data):
+    def on_cul_reconnect(self):
+        """CUL device may have been reset, enable listening mode again"""
+        self.set_listening_mode()
+
+    def send_discovery(self, reading):
         """
         Send Home Assistant - compatible discovery messages
 
@@ -43,8 +281,9 @@ class LaCrosse:
         https://www.home-assistant.io/integrations/sensor.mqtt/
         """
         # register id as known to not send discovery every time
-        self.devices.append(parsed_data["id"])
-        unit_id = str(parsed_data["id"])
+        self.devices.add(reading.id)
+        unit_id = str(reading.id)
+        state_topic = self.get_topics(reading.id).state
         # temperature
         configuration = {
             "device_class": "temperature",
@@ -52,7 +291,7 @@ class LaCrosse:
             "name": "LaCrosse " + unit_id + " Temperature",
             "unique_id": "lacrosse_" + unit_id + "_temperature",
             "unit_of_measurement": "°C",
-            "state_topic": self.prefix + "/sensor/lacrosse/" + unit_id + "/state",
+            "state_topic": state_topic,
             "value_template": "{{value_json.temperature}}",
             "device": {
                 "name": "Temperatur / Luftfeuchtesensor " + unit_id,
@@ -70,7 +309,7 @@ class LaCrosse:
             "name": "LaCrosse " + unit_id + " Humidity",
             "unique_id": "lacrosse_" + unit_id + "_humidity",
             "unit_of_measurement": "%",
-            "state_topic": self.prefix + "/sensor/lacrosse/" + unit_id + "/state",
+            "state_topic": state_topic,
             "value_template": "{{value_json.humidity}}",
             "device": {
                 "name": "Temperatur / Luftfeuchtesensor " + unit_id,
@@ -87,7 +326,7 @@ class LaCrosse:
             "name": "LaCrosse " + unit_id + " Battery",
             "unique_id": "lacrosse_" + unit_id + "_battery",
             "unit_of_measurement": "%",
-            "state_topic": self.prefix + "/sensor/lacrosse/" + unit_id + "/state",
+            "state_topic": state_topic,
             "value_template": "{{value_json.battery}}",
             "device": {
                 "name": "Temperatur / Luftfeuchtesensor " + unit_id,
@@ -113,7 +352,8 @@ class LaCrosse:
         return crc
 
 
-    def decode_rx_data(self, data):
+    def decode_frame(self, data):
+        """Decode frame. Returns LaCrosseReading or None if the frame is invalid"""
         START_MARKER = slice(3, 4)
         ID           = slice(4, 6)
         TEMPERATURE  = slice(6, 9)
@@ -121,7 +361,6 @@ class LaCrosse:
         ALL_DATA     = slice(3, 11)
         CRC          = slice(11, 13)
 
-        parsed_data = {}
         try:
             if len(data) != 27:
                 raise ValueError(f"unexpected message length {len(data)}: {data}")
@@ -132,43 +371,83 @@ class LaCrosse:
             if received_crc != calculated_crc:
                 raise ValueError(f"CRC failure: received 0x{received_crc:08b}, " \
                                  f"calculated 0x{calculated_crc:08b}")
-            parsed_data["id"] = (int(data[ID], base=16) & 0x3F) >> 2
-            parsed_data["temperature"] = round(int(data[TEMPERATURE]) / 10 - 40, 1)
-            parsed_data["humidity"] = int(data[HUMIDITY], base=16) & 0x7F
-            if parsed_data["humidity"] == 106:
+            sensor_id = (int(data[ID], base=16) & 0x3F) >> 2
+            temperature = round(int(data[TEMPERATURE]) / 10 - 40, 1)
+            humidity = int(data[HUMIDITY], base=16) & 0x7F
+            if humidity == 106:
                 # 106 means no such sensor
-                del parsed_data["humidity"]
+                humidity = None
             new_battery = (int(data[ID], base=16) & 0x2) >> 1
             weak_battery = int(data[HUMIDITY][0], base=16) & 0x8 >> 7
             if weak_battery:
-                parsed_data["battery"] = 10
+                battery = 10
             elif new_battery:
-                parsed_data["battery"] = 100
+                battery = 100
             else:
-                parsed_data["battery"] = 50
+                battery = 50
         except ValueError as e:
             # decode error. log problem and ignore message / data
             logging.info(f"decode error for {data}: {e}")
-            parsed_data = {}
-        return parsed_data
+            return None
+        return LaCrosseReading(sensor_id, temperature, humidity, battery)
+
+    def decode_rx_data(self, data):
+        """Decode frame into dict, empty if the frame is invalid"""
+        reading = self.decode_frame(data)
+        return reading.as_dict() if reading is not None else {}
 
     def on_message(self, message):
         # ignore MQTT commands for lacrosse, it is RF receive-only, no commands
         pass
 
     def on_rf_message(self, message):
-        decoded = self.decode_rx_data(message.strip())
-        if "id" not in decoded:
+        """RF message handler, message is passed as bytes"""
+        try:
+            reading = self.decode_frame(message.decode("ascii"))
+        except UnicodeDecodeError:
+            reading = None
+        if reading is None:
             # message could not be decoded, ignore
             return
-        if decoded["id"] not in self.devices:
-            logging.info("sending discovery for %d", decoded["id"])
-            self.send_discovery(decoded)
+        if message[0:3] == self.mode_prefix:
+            self.slot_frames += 1
+        if self.aggregate_interval > 0:
+            self.add_sample(reading)
+        topics = self.get_topics(reading.id)
+        if self.compact:
+            self.mqtt_client.publish(topics.compact, payload=reading.compact_payload(), retain=False)
+        if not self.raw:
+            return
+        if reading.id not in self.devices:
+            logging.info("sending discovery for %d", reading.id)
+            self.send_discovery(reading)
         else:
             logging.debug("known devices: %s", str(self.devices))
-        topic = self.prefix + "/sensor/lacrosse/" + str(decoded["id"]) + "/state"
-        del decoded["id"]
-        self.mqtt_client.publish(topic, payload=json.dumps(decoded), retain=False)
+        self.mqtt_client.publish(topics.state, payload=reading.state_payload(), retain=False)
+
+    def get_topics(self, sensor_id):
+        topics = self.topics.get(sensor_id)
+        if topics is None:
+            topics = self.topics[sensor_id] = SensorTopics(self.prefix, sensor_id)
+        return topics
+
+    def add_sample(self, reading):
+        """Add received values to window of sensor"""
+        with self.lock:
+            window = self.windows.get(reading.id)
+            if window is None:
+                window = self.windows[reading.id] = SensorWindow(self.window_size)
+            window.add(reading.temperature, reading.humidity, reading.battery)
+
+    def publish_aggregates(self):
+        """Publish min / max / mean of each sensor with samples in the current window"""
+        with self.lock:
+            aggregates = {
+                sensor_id: window.aggregate() for sensor_id, window in self.windows.items() if window.count > 0
+            }
+        for sensor_id, aggregate in aggregates.items():
+            aggregate["interval"] = self.aggregate_interval
+            self.mqtt_client.publish(self.get_topics(sensor_id).aggregate, payload=json.dumps(aggregate), retain=False)
 
 
 def test_decode_data():
@@ -216,3 +495,66 @@ def test_real_data():
     ]
     for m in messages:
         logging.info(lacrosse.decode_rx_data(m))
+
+def test_aggregate():
+    window = SensorWindow(4)
+    for temperature, humidity in ((20.0, 40), (21.0, None), (22.0, 50)):
+        window.add(temperature, humidity, 100)
+    assert window.aggregate() == {
+        "count": 3,
+        "battery": 100,
+        "temperature": {"min": 20.0, "max": 22.0, "mean": 21.0},
+        "humidity": {"min": 40.0, "max": 50.0, "mean": 45.0},
+    }
+    # ring buffer keeps the last 4 samples only
+    for temperature in range(6):
+        window.add(temperature, 50, 50)
+    assert window.aggregate()["temperature"] == {"min": 2.0, "max": 5.0, "mean": 3.5}
+    assert window.count == 0
+
+def test_close(mqtt_client, make_config):
+    from ..scheduler import Scheduler
+
+    lacrosse = LaCrosse(cul.Cul("", test=True), mqtt_client, "homeassistant",
+                        make_config("lacrosse", raw="false", aggregate_interval="0.05",
+                                    modes="1, 2", cycle_time="0.1", tx_guard="0"), Scheduler())
+    lacrosse.on_rf_message(b"N0199E6282EC7AAAA0000719199")
+    lacrosse.close()
+    time.sleep(0.15)
+    assert not [topic for topic, _ in mqtt_client.published if topic.endswith("/aggregate")]
+    assert lacrosse.mode == 1
+    lacrosse.switch_mode()
+    assert lacrosse.mode == 1 and lacrosse.mode_task is None
+
+def test_invalid_window_size(mqtt_client, make_config):
+    lacrosse = LaCrosse(cul.Cul("", test=True), mqtt_client, "homeassistant",
+                        make_config("lacrosse", window_size="0", aggregate_interval="60"))
+    assert lacrosse.window_size == 64
+    lacrosse.on_rf_message(b"N0199E6282EC7AAAA0000719199")
+    assert mqtt_client.published[-1][0].endswith("/state")
+
+def test_mode_shares():
+    assert compute_shares({1: 0.0, 2: 0.0}, 0.1) == {1: 0.5, 2: 0.5}
+    shares = compute_shares({1: 3.0, 2: 1.0, 3: 0.0}, 0.1)
+    assert round(shares[1], 3) == 0.625
+    assert round(shares[2], 3) == 0.275
+    assert shares[3] == 0.1
+
+def test_state_payload():
+    cul_device = cul.Cul("", test=True)
+    lacrosse = LaCrosse(cul_device, None, None)
+    for m in ("N0199E6282EC7AAAA0000719199", "N019986373FC9AAAA0000000783"):
+        decoded = lacrosse.decode_rx_data(m)
+        del decoded["id"]
+        assert lacrosse.decode_frame(m).state_payload() == json.dumps(decoded)
+    assert LaCrosseReading(1, -5.0, None, 10).state_payload() == json.dumps({"temperature": -5.0, "battery": 10})
+
+def test_compact_payload():
+    cul_device = cul.Cul("", test=True)
+    lacrosse = LaCrosse(cul_device, None, None)
+    reading = lacrosse.decode_frame("N0199E6282EC7AAAA0000719199")
+    payload = reading.compact_payload()
+    assert len(payload) == COMPACT_STATE.size == 5
+    assert decode_compact_payload(payload).as_dict() == reading.as_dict()
+    assert decode_compact_payload(LaCrosseReading(3, -12.5, None, 10).compact_payload()).as_dict() == \
+        {"id": 3, "temperature": -12.5, "battery": 10}
@@ -9,9 +9,55 @@ import sys
 import json
 import logging
 import os
+import threading
 import time
 
-from threading import Timer
+from ..metrics import Histogram
+
+
+class SomfyRecord:
+    """
+    Persistent state of a Somfy device, stored in the JSON state file.
+    Optional values are None if not set. Unknown keys of the state file are
+    kept in extra (None if there are none) and written back unchanged.
+    """
+    __slots__ = ("name", "device_class", "address", "enc_key", "rolling_code",
+                 "up_time", "down_time", "current_pos", "extra")
+
+    REQUIRED = ("name", "device_class", "address", "enc_key", "rolling_code")
+    OPTIONAL = ("up_time", "down_time", "current_pos")
+
+    def __init__(self, name, device_class, address, enc_key, rolling_code,
+                 up_time=None, down_time=None, current_pos=None, extra=None):
+        self.name = name
+        self.device_class = device_class
+        self.address = address
+        self.enc_key = enc_key
+        self.rolling_code = rolling_code
+        self.up_time = up_time
+        self.down_time = down_time
+        self.current_pos = current_pos
+        self.extra = extra or None
+
+    @classmethod
+    def from_dict(cls, state):
+        """ Create record from content of state file. Raises KeyError if a required key is missing """
+        extra = dict(state)
+        values = {key: extra.pop(key) for key in cls.REQUIRED}
+        values.update({key: extra.pop(key) for key in cls.OPTIONAL if key in extra})
+        return cls(extra=extra, **values)
+
+    def to_dict(self):
+        """ Content of state file """
+        state = {key: getattr(self, key) for key in self.REQUIRED}
+        for key in self.OPTIONAL:
+            value = getattr(self, key)
+            if value is not None:
+                state[key] = value
+        if self.extra:
+            state.update(self.extra)
+        return state
+
 
 class SomfyShutter:
     """
@@ -22,28 +68,75 @@ class SomfyShutter:
     """
 
     class SomfyShutterState:
-        def __init__(self, mqtt_client, prefix, statedir, statefile):
+        __slots__ = ("mqtt_client", "scheduler", "position_interval", "statefile", "state", "mtime",
+                     "base_path", "drv_timer", "stop_timer", "pos_timer", "cmd_time", "start_pos",
+                     "target_pos", "direction", "published_pos", "on_target_reached", "lock")
+
+        def __init__(self, mqtt_client, prefix, statedir, statefile, scheduler, position_interval=0):
             self.mqtt_client = mqtt_client
+            self.scheduler = scheduler
+            self.position_interval = position_interval   # seconds between intermediate positions
             
             self.statefile = statedir + "/somfy/" + statefile
-            logging.info("Reading device config from statefile %s", self.statefile)
-            with open(self.statefile, "r", encoding='utf8') as file_handle:
-                self.state = json.loads(file_handle.read())
+            self.state = self.read_statefile()
 
             """
             Up and down timers
 
             Add up_time and down_time entries to .json state file of your Somfy device to enable up/down timers
             """
-            self.drv_timer = None    # Timer for opening / closing the shutter
-            self.cmd_time = 0        # Timestamp of last open or close command. Used to calculate stop position
+            self.drv_timer = None    # Task for end of opening / closing the shutter
+            self.stop_timer = None   # Task for stopping at target position
+            self.pos_timer = None    # Task for publishing intermediate positions
+            self.cmd_time = 0        # Start time of movement. Used to calculate current position
+            self.start_pos = 0       # Position at start of movement
+            self.target_pos = None   # Requested position (set_position) or None
             self.direction = 0       # 1 = opening, -1 = closing, 0 = stopped
-            
-            if len(self.state["address"]) != 6:
-                raise ValueError(f"Address in {statefile} must be 3 bytes long")
-        
-            self.base_path = prefix + "/cover/somfy/" + self.state["address"]
+            self.published_pos = None    # Last retained position, None = publish on next update
+            self.on_target_reached = None    # Called with self when target position is reached
+            self.lock = threading.RLock()    # Guards movement state, replaced by the lock of SomfyShutter
+
+            self.base_path = prefix + "/cover/somfy/" + self.state.address
+            self.send_discovery()
 
+            # Publish current state and position
+            if self.state.current_pos is not None:
+                if self.state.current_pos == 100:
+                    self.publish_devstate("open", 100)
+                elif self.state.current_pos == 0:
+                    self.publish_devstate("closed", 0)
+                else:
+                    self.publish_devstate("stopped", self.state.current_pos)
+            else:
+                self.publish_devstate("stopped")    # Current position is unknown
+
+        def read_statefile(self):
+            """ Read and check state file, remember modification time to detect external changes """
+            logging.info("Reading device config from statefile %s", self.statefile)
+            with open(self.statefile, "r", encoding='utf8') as file_handle:
+                state = SomfyRecord.from_dict(json.loads(file_handle.read()))
+            self.mtime = os.stat(self.statefile).st_mtime_ns
+            if len(state.address) != 6:
+                raise ValueError(f"Address in {self.statefile} must be 3 bytes long")
+            return state
+
+        def is_modified(self):
+            """ True if state file has been changed by someone else """
+            return os.stat(self.statefile).st_mtime_ns != self.mtime
+
+        def reload(self):
+            """
+            Read modified state file. Movement and timers are kept. Returns False
+            if the address has changed, the device must be created again in this case.
+            """
+            state = self.read_statefile()
+            if state.address != self.state.address:
+                return False
+            self.state = state
+            self.send_discovery()
+            return True
+
+        def send_discovery(self):
             """
             Send Home Assistant - compatible discovery messages
 
@@ -64,29 +157,25 @@ class SomfyShutter:
                 "payload_stop": "STOP",
                 "position_topic": self.base_path + "/position",
                 "state_topic": self.base_path + "/state",
-                "device_class": self.state["device_class"],
-                "name": self.state["name"],
-                "unique_id": "somfy_" + self.state["address"],
+                "device_class": self.state.device_class,
+                "name": self.state.name,
+                "unique_id": "somfy_" + self.state.address,
             }
+            if self.state.up_time is not None and self.state.down_time is not None:
+                configuration["set_position_topic"] = "~/set_position"
 
             # Publish configuration
             self.mqtt_client.publish(self.base_path + "/config", payload=json.dumps(configuration), retain=True)
-            
-            # Publish current state and position
-            if "current_pos" in self.state:
-                if self.state["current_pos"] == 100:
-                    self.publish_devstate("open", 100)
-                elif self.state["current_pos"] == 0:
-                    self.publish_devstate("closed", 0)
-                else:
-                    self.publish_devstate("stopped", self.state["current_pos"])
-            else:
-                self.publish_devstate("stopped")    # Current position is unknown
-                  
+
+        def remove_discovery(self):
+            """ Remove device from Home Assistant by publishing empty configuration """
+            self.mqtt_client.publish(self.base_path + "/config", payload="", retain=True)
+
         def save(self):
             """Save state to JSON file"""
             with open(self.statefile, "w", encoding='utf8') as file_handle:
-                json.dump(self.state, file_handle)
+                json.dump(self.state.to_dict(), file_handle)
+            self.mtime = os.stat(self.statefile).st_mtime_ns
 
         def increase_rolling_code(self):
             """
@@ -94,95 +183,144 @@ class SomfyShutter:
             Increment enc_key, roll over when crossing the 4 bit boundary.
             Save updated state to statefile
             """
-            self.state["rolling_code"] = (self.state["rolling_code"] + 1) % 0x10000
-            self.state["enc_key"]      = (self.state["enc_key"] + 1) % 0x10
+            self.state.rolling_code = (self.state.rolling_code + 1) % 0x10000
+            self.state.enc_key      = (self.state.enc_key + 1) % 0x10
             self.save()
 
             """ don't loose the code during testing ;) """
             logging.info("next rolling code for device %s is %d, encryption key is %d",
-                         self.state["address"], self.state["rolling_code"], self.state["enc_key"])
+                         self.state.address, self.state.rolling_code, self.state.enc_key)
 
         def publish_devstate(self, devstate, position = None):
             """
             Publish state and position of shutter.
-            Save state if position is specified and has changed
+            Publish position if it differs from the last published one,
+            save state if it differs from the stored one
             """
-            logging.debug("publishing devstate %s for device %s", devstate, self.state["address"])
+            logging.debug("publishing devstate %s for device %s", devstate, self.state.address)
             self.mqtt_client.publish(self.base_path + "/state", payload=devstate, retain=True)
-            if position is not None and ("current_pos" not in self.state or position != self.state["current_pos"]):
-                self.state["current_pos"] = position
-                logging.debug("publishing position %d for device %s", position, self.state["address"])
+            if position is None:
+                return
+            if position != self.published_pos:
+                self.published_pos = position
+                logging.debug("publishing position %d for device %s", position, self.state.address)
                 self.mqtt_client.publish(self.base_path + "/position", payload=position, retain=True)
+            if position != self.state.current_pos:
+                self.state.current_pos = position
                 self.save()
 
         def reset_timer(self):
-            """ Reset timer functions """
-            if self.drv_timer is not None:
-                self.drv_timer.cancel()
-                self.drv_timer = None
+            """ Cancel scheduled tasks of a movement """
+            for task in (self.drv_timer, self.stop_timer, self.pos_timer):
+                if task is not None:
+                    task.cancel()
+            self.drv_timer = None
+            self.stop_timer = None
+            self.pos_timer = None
+
+        def end_movement(self):
+            self.reset_timer()
+            self.cmd_time = 0
+            self.direction = 0
+            self.target_pos = None
 
         def timer_open(self):
             """ Timer function called when shutter has been opened """
-            self.publish_devstate("open", position=100)
+            with self.lock:
+                self.end_movement()
+                self.publish_devstate("open", position=100)
 
         def timer_closed(self):
             """ Timer function called when shutter has been closed """
-            self.publish_devstate("closed", position=0)
-
-        def start_timer(self, devstate):
-            self.publish_devstate(devstate)
+            with self.lock:
+                self.end_movement()
+                self.publish_devstate("closed", position=0)
+
+        def timer_target(self):
+            """ Timer function called when shutter has reached the requested position """
+            if self.on_target_reached is not None:
+                self.on_target_reached(self)
+
+        def current_position(self):
+            """ Calculate position from start position of the movement and elapsed time """
+            if self.direction == 0:
+                return self.state.current_pos
+            travel_time = self.state.up_time if self.direction == 1 else self.state.down_time
+            position = self.start_pos + (time.monotonic() - self.cmd_time) / travel_time * 100 * self.direction
+            return max(min(position, 100), 0)    # Make sure that pos is in range 0..100
+
+        def publish_position(self):
+            """ Publish intermediate position while moving, state file is not updated """
+            self.mqtt_client.publish(self.base_path + "/position", payload=round(self.current_position()), retain=False)
+
+        def start_timer(self, devstate, target_pos=None):
+            """
+            Start movement. Schedule end of movement, STOP at target position and
+            publishing of intermediate positions.
+            """
+            if self.direction != 0:
+                start_pos = self.current_position()
+            else:
+                # if position is unknown, assume the longest way
+                start_pos = self.state.current_pos
+                if start_pos is None:
+                    start_pos = 0 if devstate == "opening" else 100
             self.reset_timer()
-            self.cmd_time = time.time()
-            
+            self.publish_devstate(devstate)
+            # intermediate positions are not retained, always publish the final one
+            self.published_pos = None
+            self.start_pos = start_pos
+            self.target_pos = target_pos
+            self.cmd_time = time.monotonic()
+
             if devstate == "opening":
                 # Opening shutter. Remaining time until state "open" depends on current position
                 self.direction = 1
-                timeout = self.state["up_time"]
-                if "current_pos" in self.state:
-                    timeout = timeout * (1 - self.state["current_pos"] / 100) + 1
-                self.drv_timer = Timer(timeout, self.timer_open)
+                travel_time = self.state.up_time
+                timeout = travel_time * (100 - start_pos) / 100
+                # add 1 second for the drive to reach the end position
+                self.drv_timer = self.scheduler.call_later(timeout + 1, self.timer_open)
             else:
                 self.direction = -1
-                timeout = self.state["down_time"]
-                if "current_pos" in self.state:
-                    timeout = timeout * self.state["current_pos"] / 100 + 1
-                self.drv_timer = Timer(self.state["down_time"], self.timer_closed)
-                
-            self.drv_timer.start()
-            
-        def update_state(self, cmd):
+                travel_time = self.state.down_time
+                timeout = travel_time * start_pos / 100
+                self.drv_timer = self.scheduler.call_later(timeout + 1, self.timer_closed)
+
+            if target_pos is not None:
+                self.stop_timer = self.scheduler.call_later(
+                    travel_time * abs(target_pos - start_pos) / 100, self.timer_target)
+            if self.position_interval > 0:
+                self.pos_timer = self.scheduler.call_every(self.position_interval, self.publish_position)
+
+        def update_state(self, cmd, target_pos=None):
             """ calculate position, publish state and position """
-            if cmd == "OPEN":
-                if "up_time" in self.state:
-                    logging.debug("opening device %s. setting timer to %d seconds", self.state["address"], self.state['up_time'])
-                    self.start_timer("opening")
-                else:
-                    self.publish_devstate("open", position=100)
+            with self.lock:
+                if cmd == "OPEN":
+                    if self.state.up_time is not None:
+                        logging.debug("opening device %s. up time is %d seconds", self.state.address, self.state.up_time)
+                        self.start_timer("opening", target_pos)
+                    else:
+                        self.publish_devstate("open", position=100)
                     
-            elif cmd == "CLOSE":
-                if "down_time" in self.state:
-                    logging.debug("closing device %s. setting timer to %d seconds", self.state["address"], self.state['down_time'])
-                    self.start_timer("closing")
-                else:
-                    self.publish_devstate("closed", position=0)
+                elif cmd == "CLOSE":
+                    if self.state.down_time is not None:
+                        logging.debug("closing device %s. down time is %d seconds", self.state.address, self.state.down_time)
+                        self.start_timer("closing", target_pos)
+                    else:
+                        self.publish_devstate("closed", position=0)
                     
-            elif cmd == "STOP":
-                current_pos = 50 if "current_pos" not in self.state else self.state["current_pos"]               
-                current_time = time.time()
-                
-                if self.drv_timer is not None and self.direction != 0:
-                    self.reset_timer()
-                    if self.cmd_time > 0:
-                        ti = current_time - self.cmd_time
-                        dt = "up_time" if self.direction == 1 else "down_time"
-                        current_pos += int(ti / self.state[dt] * 100) * self.direction
-
-                current_pos = max(min(current_pos,100), 0)    # Make sure that pos is in range 0..100
-
-                """ publish stopped state and calculated position """
-                self.publish_devstate("stopped", position=current_pos)
-                self.cmd_time = 0
-                self.direction = 0                
+                elif cmd == "STOP":
+                    current_pos = self.current_position()
+                    if current_pos is None:
+                        current_pos = 50
+                    current_pos = round(current_pos)
+                    if self.target_pos is not None and abs(current_pos - self.target_pos) <= 2:
+                        # stopped by schedule, difference is caused by RF latency
+                        current_pos = self.target_pos
+                    self.end_movement()
+
+                    """ publish stopped state and calculated position """
+                    self.publish_devstate("stopped", position=current_pos)
 
         def calculate_checksum(self, command):
             """
@@ -228,10 +366,10 @@ class SomfyShutter:
             }
             if command in commands:
                 command_string = "A{:01X}{}{:04X}{}".format(
-                    self.state["enc_key"],
+                    self.state.enc_key,
                     commands[command],
-                    self.state["rolling_code"],
-                    self.state["address"]
+                    self.state.rolling_code,
+                    self.state.address
                 )
             else:
                 raise NameError("unknown command")
@@ -246,25 +384,121 @@ class SomfyShutter:
     """
     Implementation of class SomfyShutter
     """
-    def __init__(self, cul, mqtt_client, prefix, statedir):
+    def __init__(self, cul, mqtt_client, prefix, statedir, config, scheduler):
         self.cul = cul
+        self.mqtt_client = mqtt_client
         self.prefix = prefix
+        self.statedir = statedir
+        self.scheduler = scheduler
         self.calibrate = 0
         self.cal_start = 0
-
         self.devices = []
+        # Commands are sent from the MQTT thread and by scheduled STOPs. Held while a
+        # frame is built and sent and the rolling code increased, and by the devices
+        # while changing their movement state
+        self.lock = threading.RLock()
+        self.configure(config)
+
+        self.ack_lock = threading.Lock()
+        self.pending = {}        # (address, rolling_code) -> pending frame
+        self.ack_latency = Histogram()
+        self.stats = { "sent": 0, "acked": 0, "retried": 0, "lost": 0 }
+        self.stats_topic = self.prefix + "/sensor/mqtt_cul_server/somfy/stats"
 
         try:   
-            for statefile in os.listdir(statedir + "/somfy/"):
-                if ".json" in statefile:
-                    try:
-                        self.devices.append(self.SomfyShutterState(mqtt_client, prefix, statedir, statefile))
-                    except:
-                        logging.error("Error reading state file %s", statefile)
+            for statefile in self.list_statefiles():
+                device = self.load_device(statefile)
+                if device is not None:
+                    self.devices.append(device)
         except:
             logging.error("Error reading state files from directory %s", statedir + "/somfy")
             sys.exit(1)
 
+    def configure(self, config):
+        """
+        Set position interval of all devices and ack options. Running movements
+        and pending frames are kept, ack options apply to the next frame
+        """
+        # seconds between intermediate positions while moving, 0 = disabled
+        self.position_interval = config.getfloat("position_interval", fallback=1)
+
+        """
+        Transmit acknowledgement
+
+        The CUL echoes each sent frame. If ack_timeout (seconds) is > 0, the state
+        of a device is only updated after the echo has been received. Frames without
+        echo are sent again up to "retries" times.
+        """
+        self.ack_timeout = config.getfloat("ack_timeout", fallback=0)
+        self.retries = config.getint("retries", fallback=2)
+
+        for device in self.devices:
+            device.position_interval = self.position_interval
+
+    def close(self):
+        """ Cancel movement timers of all devices and pending ack retries """
+        with self.lock:
+            for device in self.devices:
+                device.reset_timer()
+        with self.ack_lock:
+            for frame in self.pending.values():
+                frame["timer"].cancel()
+            self.pending.clear()
+
+    def list_statefiles(self):
+        return [f for f in os.listdir(self.statedir + "/somfy/") if ".json" in f]
+
+    def load_device(self, statefile):
+        """ Create device from state file. Returns None on error """
+        try:
+            device = self.SomfyShutterState(self.mqtt_client, self.prefix, self.statedir, statefile,
+                                            self.scheduler, self.position_interval)
+        except:
+            logging.error("Error reading state file %s", statefile)
+            return None
+        device.on_target_reached = self.stop_at_target
+        device.lock = self.lock
+        return device
+
+    def reload_devices(self):
+        """
+        Apply new, modified and removed state files. Unchanged devices are kept
+        including their movement, timers and pending frames.
+        """
+        try:
+            statefiles = {self.statedir + "/somfy/" + f: f for f in self.list_statefiles()}
+        except OSError as e:
+            logging.error("Error reading state files from directory %s: %s", self.statedir + "/somfy", e)
+            return
+
+        devices = []
+        for device in self.devices:
+            if device.statefile not in statefiles:
+                logging.info("State file %s removed. Removing device %s", device.statefile, device.state.address)
+                device.reset_timer()
+                device.remove_discovery()
+                continue
+            statefile = statefiles.pop(device.statefile)
+            try:
+                if device.is_modified():
+                    logging.info("State file %s modified. Reloading", device.statefile)
+                    if not device.reload():
+                        device.reset_timer()
+                        device.remove_discovery()
+                        device = self.load_device(statefile)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error("Error reading state file %s: %s. Keeping previous state", device.statefile, e)
+            if device is not None:
+                devices.append(device)
+
+        for statefile in statefiles.values():
+            logging.info("New state file %s", statefile)
+            device = self.load_device(statefile)
+            if device is not None:
+                devices.append(device)
+
+        self.devices = devices
+
     @classmethod
     def get_component_name(cls):
         return "somfy"
@@ -282,18 +516,133 @@ class SomfyShutter:
             
             logging.info("enc_key=%s, cmd=%s, rolling_code=%s, address=%s", enc_key, cmd, rolling_code, address)     
 
-    def send_command(self, command, device):
-        """Send command string via CUL device"""
-        command_string = device.command_string(command)
-        logging.debug("sending command string %s to %s", command_string, device.state["name"])
-        self.log_message(command)
-        self.cul.send_command(command_string)
-        device.increase_rolling_code()
+    def send_command(self, command, device, mqtt_command=None, target_pos=None):
+        """
+        Send command string via CUL device.
+        mqtt_command and target_pos are passed to device.update_state() when the
+        frame has been sent
+        """
+        with self.lock:
+            command_string = device.command_string(command)
+            logging.debug("sending command string %s to %s", command_string, device.state.name)
+            self.log_message(command)
+
+            if self.ack_timeout > 0:
+                key = (device.state.address.upper(), device.state.rolling_code)
+                frame = {
+                    "command_string": command_string,
+                    "device": device,
+                    "mqtt_command": mqtt_command,
+                    "target_pos": target_pos,
+                    "tx_time": time.monotonic(),
+                    "retries": self.retries,
+                }
+                with self.ack_lock:
+                    self.pending[key] = frame
+                    self.stats["sent"] += 1
+                    self.cul.send_command(command_string)
+                    frame["timer"] = self.scheduler.call_later(self.ack_timeout, self.ack_timeout_expired, key)
+            else:
+                self.cul.send_command(command_string)
+                if mqtt_command is not None:
+                    device.update_state(mqtt_command, target_pos)
+            device.increase_rolling_code()
+
+    def ack_timeout_expired(self, key):
+        """ Timer function called if the CUL didn't echo a frame """
+        with self.ack_lock:
+            frame = self.pending.get(key)
+            if frame is None:
+                return
+            if frame["retries"] > 0:
+                frame["retries"] -= 1
+                self.stats["retried"] += 1
+                logging.warning("no echo for frame %s from CUL. Sending again", frame["command_string"])
+                frame["tx_time"] = time.monotonic()
+                self.cul.send_command(frame["command_string"])
+                frame["timer"] = self.scheduler.call_later(self.ack_timeout, self.ack_timeout_expired, key)
+                return
+            del self.pending[key]
+            self.stats["lost"] += 1
+        logging.error("frame %s to device %s has not been sent by CUL",
+                      frame["command_string"], frame["device"].state.name)
+        self.publish_stats()
+
+    def acknowledge(self, message):
+        """
+        Match echo of the CUL with pending frame by address and rolling code.
+        Returns the pending frame or None
+        """
+        if len(message) < 16:
+            return None
+        try:
+            key = (message[10:16].upper(), int(message[6:10], 16))
+        except ValueError:
+            return None
+        with self.ack_lock:
+            frame = self.pending.pop(key, None)
+            if frame is None:
+                return None
+            frame["timer"].cancel()
+            self.stats["acked"] += 1
+        latency = (time.monotonic() - frame["tx_time"]) * 1000
+        self.ack_latency.observe(latency)
+        logging.debug("frame %s acknowledged after %.1f ms", frame["command_string"], latency)
+        return frame
+
+    def publish_stats(self):
+        """ Publish transmit counters and ack latency distribution """
+        if self.mqtt_client is None:
+            return
+        with self.ack_lock:
+            stats = dict(self.stats)
+        stats["pending"] = len(self.pending)
+        stats["ack_latency_ms"] = self.ack_latency.as_dict()
+        self.mqtt_client.publish(self.stats_topic, payload=json.dumps(stats), retain=False)
+
+    def stop_at_target(self, device):
+        """ Send STOP when the shutter has reached the position requested by set_position """
+        logging.debug("device %s reached target position %d", device.state.address, device.target_pos)
+        self.send_command("my", device, "STOP")
+
+    def set_position(self, device, position):
+        """ Move shutter to position by sending OPEN or CLOSE and scheduling a STOP """
+        if device.state.up_time is None or device.state.down_time is None:
+            logging.error("set_position requires up_time and down_time for device %s", device.state.address)
+            return
+        if position == 100:
+            self.send_command("up", device, "OPEN")
+            return
+        if position == 0:
+            self.send_command("down", device, "CLOSE")
+            return
+        with self.lock:
+            current_pos = device.current_position()
+            if current_pos is None:
+                logging.error("Position of device %s is unknown. Open or close it first", device.state.address)
+                return
+            if round(current_pos) == position:
+                return
+            if position > current_pos:
+                self.send_command("up", device, "OPEN", position)
+            else:
+                self.send_command("down", device, "CLOSE", position)
 
     def on_rf_message(self, message):
-        """ dummy RF message handler, simply log the message """
+        """ RF message handler. Echo of a sent frame completes the transmission """
+        try:
+            message = message.decode("ascii").strip()
+        except UnicodeDecodeError:
+            logging.warning("cannot decode SOMFY message %s", message)
+            return
         logging.debug("received SOMFY message %s", message)
         self.log_message(message)
+        frame = self.acknowledge(message)
+        if frame is None:
+            return
+        if frame["mqtt_command"] is not None:
+            frame["device"].update_state(frame["mqtt_command"], frame["target_pos"])
+        self.publish_stats()
         
     def on_message(self, message):
         """ MQTT message handler """
@@ -316,7 +665,7 @@ class SomfyShutter:
 
         device = None
         for d in self.devices:
-            if d.state["address"] == address:
+            if d.state.address == address:
                 device = d
                 break
         if not device:
@@ -345,9 +694,9 @@ class SomfyShutter:
             elif command == "STOP" and self.calibrate == 1:
                 """ measure down_time """
                 self.calibrate = 2
-                device.state["down_time"] = int(time.time() - self.cal_start)
+                device.state.down_time = int(time.time() - self.cal_start)
                 logging.info("Measured down time of %d seconds for device %s. Waiting 5 seconds before measuring up time",
-                             device.state["down_time"], address)
+                             device.state.down_time, address)
                 time.sleep(5)
                 logging.info("Measuring up time for device %s. Press STOP when shutter is open and drive has stopped", address)
                 self.cal_start = time.time()
@@ -355,19 +704,129 @@ class SomfyShutter:
                 
             elif command == "STOP" and self.calibrate == 2:
                 """ measure up_time and stop calibration """
-                device.state["up_time"] = int(time.time() - self.cal_start)
+                device.state.up_time = int(time.time() - self.cal_start)
                 device.save()
                 self.calibrate = 0
                 self.cal_start = 0
-                logging.info("Measured up time of %d seconds for device %s", device.state["up_time"], address)
+                logging.info("Measured up time of %d seconds for device %s", device.state.up_time, address)
                 logging.info("Device %s calibrated", address)
                 device.publish_devstate("open", 100)
                 
             elif command in cmd_lookup:
-                self.send_command(cmd_lookup[command], device)
-                device.update_state(command)
+                self.send_command(cmd_lookup[command], device, command)
                 
             else:
                 logging.error("Command %s is not supported", command)
+        elif topic == "set_position":
+            try:
+                position = int(command)
+            except ValueError:
+                logging.error("Invalid position %s", command)
+                return
+            if not 0 <= position <= 100:
+                logging.error("Position %d out of range 0..100", position)
+                return
+            self.set_position(device, position)
         elif topic not in ("config", "state", "position"):
             logging.warning("ignoring topic %s", topic)
+
+
+def test_acknowledge(make_somfy):
+    somfy = make_somfy(ack_timeout="5")
+    device = somfy.devices[0]
+    echo = device.command_string("up").strip()
+    somfy.send_command("up", device, "OPEN")
+    assert device.state.current_pos == 0
+    # echo of another rolling code is ignored
+    somfy.on_rf_message(b"YsA12F101CB0C004")
+    assert somfy.stats["acked"] == 0
+    somfy.on_rf_message(echo)
+    assert somfy.stats["acked"] == 1
+    assert somfy.ack_latency.count == 1
+    assert device.direction == 1
+
+def test_retry(make_somfy, capsys):
+    somfy = make_somfy(ack_timeout="0.05", retries="1")
+    device = somfy.devices[0]
+    somfy.send_command("up", device, "OPEN")
+    time.sleep(0.3)
+    sent = capsys.readouterr().out
+    assert sent.count("YsA") == 2
+    assert somfy.stats["retried"] == 1
+    assert somfy.stats["lost"] == 1
+    assert device.state.current_pos == 0
+
+def test_command_lock(make_somfy):
+    somfy = make_somfy()
+    device = somfy.devices[0]
+    assert device.lock is somfy.lock
+    with somfy.lock:
+        # a scheduled STOP waits for a command being sent by another thread
+        sender = threading.Thread(target=somfy.send_command, args=["my", device, "STOP"])
+        sender.start()
+        sender.join(0.1)
+        assert sender.is_alive()
+        assert device.state.rolling_code == 4125
+    sender.join()
+    assert device.state.rolling_code == 4126
+
+def test_set_position(make_somfy):
+    somfy = make_somfy(position_interval="0.1")
+    device = somfy.devices[0]
+    somfy.set_position(device, 40)
+    assert device.direction == 1
+    time.sleep(0.25)
+    assert 0 < device.current_position() < 40
+    time.sleep(0.3)
+    assert device.direction == 0
+    assert device.state.current_pos == 40
+    positions = [payload for topic, payload in somfy.mqtt_client.published if topic.endswith("/position")]
+    assert len(positions) >= 3
+    somfy.on_message(type("Message", (), {"topic": "homeassistant/cover/somfy/B0C004/set_position", "payload": b"0"}))
+    assert device.direction == -1
+    time.sleep(0.4 + 1.1)
+    assert device.state.current_pos == 0
+
+def test_final_position(make_somfy):
+    somfy = make_somfy(position_interval="0.05")
+    device = somfy.devices[0]
+    device.publish_devstate("stopped", 40)
+    device.update_state("OPEN")
+    time.sleep(0.15)
+    device.update_state("CLOSE")
+    time.sleep(0.15)
+    device.update_state("STOP")
+    published = [(topic.rsplit("/", 1)[1], payload) for topic, payload in somfy.mqtt_client.published]
+    assert published[-2:] == [("state", "stopped"), ("position", device.state.current_pos)]
+    assert 35 <= device.state.current_pos <= 45
+
+def test_reload_devices(make_somfy, tmp_path):
+    somfy = make_somfy()
+    device = somfy.devices[0]
+    device.state.current_pos = 30
+    statefile = tmp_path / "somfy" / "test.json"
+    with open(statefile, "w", encoding='utf8') as file_handle:
+        json.dump(dict(device.state.to_dict(), name="Renamed"), file_handle)
+    os.utime(statefile, ns=(0, 0))
+    with open(tmp_path / "somfy" / "new.json", "w", encoding='utf8') as file_handle:
+        json.dump({"name": "New", "device_class": "shade", "address": "B0C005",
+                   "enc_key": 1, "rolling_code": 1}, file_handle)
+    somfy.reload_devices()
+    assert len(somfy.devices) == 2
+    assert somfy.devices[0] is device
+    assert device.state.name == "Renamed"
+    assert device.state.current_pos == 30
+    assert somfy.devices[1].state.address == "B0C005"
+
+    os.remove(tmp_path / "somfy" / "new.json")
+    somfy.reload_devices()
+    assert [d.state.address for d in somfy.devices] == ["B0C004"]
+    assert ("homeassistant/cover/somfy/B0C005/config", "") in somfy.mqtt_client.published
+
+def test_record():
+    state = {"name": "Test", "device_class": "shade", "address": "B0C004", "enc_key": 1,
+             "rolling_code": 4125, "down_time": 10, "current_pos": 100, "comment": "kept"}
+    record = SomfyRecord.from_dict(state)
+    assert record.up_time is None
+    assert record.extra == {"comment": "kept"}
+    assert record.to_dict() == state
@@ -0,0 +1,86 @@
+"""
+Fan-out of raw RF frames to MQTT for external decoders
+
+Frames are collected for batch_interval seconds and published as one JSON
+message: {"frames": [[timestamp, frame], ...]} with the Unix time of
+reception in seconds.
+"""
+
+import json
+import logging
+import threading
+import time
+
+
+class RawFanout:
+    """Publish received raw frames in batches"""
+
+    def __init__(self, mqtt_client, prefix, scheduler, config):
+        self.mqtt_client = mqtt_client
+        self.scheduler = scheduler
+        self.topic = prefix + "/sensor/mqtt_cul_server/raw"
+        self.lock = threading.Lock()
+        self.frames = []
+        self.flush_task = None
+        self.configure(config)
+
+    def configure(self, config):
+        """
+        Apply options of section raw. Frames already collected are kept and
+        published with the current batch
+
+        all: publish all frames, otherwise only frames no component handles
+        prefixes: comma separated list of frame prefixes to publish (empty = all)
+        batch_interval: seconds to collect frames before publishing
+        max_batch: maximum number of frames per message
+        """
+        self.all = config.getboolean("all", fallback=False)
+        prefixes = config.get("prefixes", fallback="")
+        self.prefixes = tuple(p.strip().encode() for p in prefixes.split(",") if p.strip())
+        self.batch_interval = config.getfloat("batch_interval", fallback=0.5)
+        self.max_batch = config.getint("max_batch", fallback=100)
+
+    def add(self, message):
+        """Add received frame (bytes) to current batch"""
+        if self.prefixes and not message.startswith(self.prefixes):
+            return
+        frame = [round(time.time(), 3), message.decode("ascii", "replace")]
+        with self.lock:
+            self.frames.append(frame)
+            if len(self.frames) < self.max_batch:
+                if self.flush_task is None:
+                    self.flush_task = self.scheduler.call_later(self.batch_interval, self.flush)
+                return
+        self.flush()
+
+    def flush(self):
+        """Publish collected frames"""
+        with self.lock:
+            if self.flush_task is not None:
+                self.flush_task.cancel()
+                self.flush_task = None
+            frames, self.frames = self.frames, []
+        if not frames:
+            return
+        logging.debug("publishing %d raw frames", len(frames))
+        self.mqtt_client.publish(self.topic, payload=json.dumps({"frames": frames}), retain=False)
+
+
+def test_raw_fanout(mqtt_client, make_config):
+    from .scheduler import Scheduler
+
+    config = make_config("raw", prefixes="F, T", batch_interval="0.05", max_batch="3")
+    fanout = RawFanout(mqtt_client, "homeassistant", Scheduler(), config)
+    fanout.add(b"F12340111")
+    fanout.add(b"N0199E6282EC7AAAA0000719199")
+    fanout.add(b"T1234567890")
+    time.sleep(0.15)
+    assert len(mqtt_client.published) == 1
+    topic, payload = mqtt_client.published[0]
+    payload = json.loads(payload)
+    assert topic == "homeassistant/sensor/mqtt_cul_server/raw"
+    assert [frame for _, frame in payload["frames"]] == ["F12340111", "T1234567890"]
+
+    for _ in range(3):
+        fanout.add(b"F12340111")
+    assert len(mqtt_client.published) == 2
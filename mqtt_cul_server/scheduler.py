@@ -0,0 +1,90 @@
+"""
+Shared scheduler for delayed and periodic tasks
+
+All tasks run in a single thread, so there is no need for a timer thread per
+device. Tasks should return quickly, they delay all following tasks.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class ScheduledTask:
+    """Handle of a scheduled task, can be used to cancel the task"""
+
+    def __init__(self, when, interval, callback, args):
+        self.when = when
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """Run callbacks after a delay or periodically in a single thread"""
+
+    def __init__(self):
+        self.queue = []
+        self.counter = itertools.count()    # tie breaker for tasks with same time
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds"""
+        return self.add(ScheduledTask(time.monotonic() + delay, None, callback, args))
+
+    def call_every(self, interval, callback, *args):
+        """Call callback(*args) every interval seconds, first call after interval"""
+        return self.add(ScheduledTask(time.monotonic() + interval, interval, callback, args))
+
+    def add(self, task):
+        with self.condition:
+            heapq.heappush(self.queue, (task.when, next(self.counter), task))
+            self.condition.notify()
+        return task
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    # drop cancelled tasks, so they don't keep the thread awake
+                    while self.queue and self.queue[0][2].cancelled:
+                        heapq.heappop(self.queue)
+                    if not self.queue:
+                        self.condition.wait()
+                        continue
+                    delay = self.queue[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                _, _, task = heapq.heappop(self.queue)
+                if task.interval is not None:
+                    # schedule next run relative to planned time to avoid drift
+                    task.when += task.interval
+                    heapq.heappush(self.queue, (task.when, next(self.counter), task))
+            try:
+                task.callback(*task.args)
+            except Exception:
+                logging.exception("Error in scheduled task %s", task.callback)
+
+
+def test_scheduler():
+    scheduler = Scheduler()
+    calls = []
+    scheduler.call_later(0.05, calls.append, "later")
+    scheduler.call_later(0.01, calls.append, "first")
+    scheduler.call_later(0.02, calls.append, "cancelled").cancel()
+    periodic = scheduler.call_every(0.03, calls.append, "periodic")
+    time.sleep(0.1)
+    periodic.cancel()
+    assert calls[0] == "first"
+    assert "later" in calls
+    assert "cancelled" not in calls
+    assert calls.count("periodic") >= 2